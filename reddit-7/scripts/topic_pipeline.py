@@ -0,0 +1,437 @@
+# %%
+import json
+from hashlib import blake2b
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from bertopic import BERTopic
+from bertopic.dimensionality import BaseDimensionalityReduction
+from bertopic.vectorizers import OnlineCountVectorizer
+from sentence_transformers import SentenceTransformer
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+from umap import UMAP
+
+# %%
+## Define globals
+ROOT = Path().absolute().parent
+DATA = ROOT / "data"
+PROC = DATA / "processed"
+CACHE = PROC / "topic_cache"
+
+MODEL = "distiluse-base-multilingual-cased-v1"
+## The UMAP model BERTopic creates by default
+UMAP_PARAMS = {
+    "n_neighbors": 15,
+    "n_components": 5,
+    "min_dist": 0.0,
+    "metric": "cosine",
+    "low_memory": False,
+}
+
+## Number of new texts in one partial fit of an online model
+BATCH_SIZE = 1000
+
+sentence_models = {}
+
+
+# %%
+## Define functions
+def fingerprint(embeddings: np.ndarray) -> str:
+    """Computes a short hash of the values of a matrix."""
+    digest = blake2b(np.ascontiguousarray(embeddings).tobytes(), digest_size=16)
+    return f"{embeddings.shape}-{digest.hexdigest()}"
+
+
+def get_key(texts: list, *parts) -> str:
+    """Computes a short hash of the texts and everything else the cached matrix
+    depends on (the name of the model, the UMAP parameters).
+
+    Parameters
+    ----------
+    texts
+        a list of texts.
+    *parts
+        JSON serializable values added to the key.
+
+    Returns
+    -------
+        the hash.
+    """
+    digest = blake2b(digest_size=8)
+    digest.update(json.dumps(parts, sort_keys=True).encode("utf-8"))
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_sentence_model(model_name: str = MODEL) -> SentenceTransformer:
+    """Loads a sentence transformer once per process."""
+    if model_name not in sentence_models:
+        sentence_models[model_name] = SentenceTransformer(model_name)
+    return sentence_models[model_name]
+
+
+def compute_embeddings(
+    texts: list, model_name: str = MODEL, cache: Path = CACHE
+) -> np.ndarray:
+    """Encodes the texts with a sentence transformer. The embeddings are written
+    to the cache, so the same texts and model are encoded only once.
+
+    Parameters
+    ----------
+    texts
+        a list of texts.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+
+    Returns
+    -------
+        the embeddings, one row per text.
+    """
+    path = Path(cache) / f"embeddings_{get_key(texts, model_name)}.npy"
+    if path.exists():
+        return np.load(path)
+    embeddings = load_sentence_model(model_name).encode(texts, show_progress_bar=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, embeddings)
+    return embeddings
+
+
+def fit_umap(
+    texts: list,
+    model_name: str = MODEL,
+    umap_params: dict = UMAP_PARAMS,
+    cache: Path = CACHE,
+) -> tuple:
+    """Fits UMAP on the embeddings of the texts. The fitted model and the reduced
+    matrix are written to the cache, keyed by the texts, the model and the UMAP
+    parameters.
+
+    Parameters
+    ----------
+    texts
+        a list of texts.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    umap_params, optional
+        parameters of UMAP, by default UMAP_PARAMS
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+
+    Returns
+    -------
+        a tuple with the fitted UMAP model and the reduced embeddings, one row per text.
+    """
+    key = get_key(texts, model_name, umap_params)
+    path = Path(cache) / f"umap_{key}.npy"
+    model_path = Path(cache) / f"umap_{key}.joblib"
+    if path.exists() and model_path.exists():
+        return joblib.load(model_path), np.load(path)
+    embeddings = compute_embeddings(texts, model_name=model_name, cache=cache)
+    umap_model = UMAP(**umap_params)
+    reduced = umap_model.fit_transform(embeddings)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    joblib.dump(umap_model, model_path)
+    np.save(path, reduced)
+    return umap_model, reduced
+
+
+def reduce_embeddings(
+    texts: list,
+    model_name: str = MODEL,
+    umap_params: dict = UMAP_PARAMS,
+    cache: Path = CACHE,
+) -> np.ndarray:
+    """Reduces the embeddings of the texts with UMAP (from the cache, compare
+    fit_umap).
+
+    Parameters
+    ----------
+    texts
+        a list of texts.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    umap_params, optional
+        parameters of UMAP, by default UMAP_PARAMS
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+
+    Returns
+    -------
+        the reduced embeddings, one row per text.
+    """
+    _, reduced = fit_umap(
+        texts, model_name=model_name, umap_params=umap_params, cache=cache
+    )
+    return reduced
+
+
+# %%
+## Define classes
+class CachedUMAP(BaseDimensionalityReduction):
+    """
+    A dimensionality model for BERTopic which does not fit UMAP again. For the
+    embeddings it was fitted on it returns the cached reduced matrix, for any
+    other embeddings (e.g. new texts in transform) it runs the fitted UMAP model.
+    """
+
+    def __init__(self, umap_model, embeddings: np.ndarray, reduced: np.ndarray):
+        """
+        Parameters
+        ----------
+        umap_model
+            a fitted UMAP model.
+        embeddings
+            the embeddings UMAP was fitted on.
+        reduced
+            their reduced matrix.
+        """
+        self.umap_model = umap_model
+        self.reduced = reduced
+        self._fingerprint = fingerprint(embeddings)
+
+    def fit(self, X: np.ndarray, y=None):
+        return self
+
+    def transform(self, X: np.ndarray) -> np.ndarray:
+        if fingerprint(X) == self._fingerprint:
+            return self.reduced
+        return self.umap_model.transform(X)
+
+
+# %%
+def fit_topic_model(
+    texts: list,
+    model_name: str = MODEL,
+    umap_params: dict = UMAP_PARAMS,
+    cache: Path = CACHE,
+    **kwargs,
+) -> tuple:
+    """Fits BERTopic on the cached embeddings and UMAP model, so only the
+    clustering and the topic representation are computed. The topic embeddings
+    live in the space of the sentence transformer, as with a plain BERTopic.
+
+    Parameters
+    ----------
+    texts
+        a list of texts.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    umap_params, optional
+        parameters of UMAP, by default UMAP_PARAMS
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+    **kwargs
+        other arguments of BERTopic, e.g. hdbscan_model, vectorizer_model,
+        ctfidf_model or representation_model.
+
+    Returns
+    -------
+        a tuple with the fitted model, the topics and their probabilities.
+    """
+    embeddings = compute_embeddings(texts, model_name=model_name, cache=cache)
+    umap_model, reduced = fit_umap(
+        texts, model_name=model_name, umap_params=umap_params, cache=cache
+    )
+    topic_model = BERTopic(
+        embedding_model=load_sentence_model(model_name),
+        umap_model=CachedUMAP(umap_model, embeddings=embeddings, reduced=reduced),
+        **kwargs,
+    )
+    topics, probs = topic_model.fit_transform(texts, embeddings)
+    return topic_model, topics, probs
+
+
+def update_representation(topic_model: BERTopic, texts: list, **kwargs) -> BERTopic:
+    """Recomputes only the topic representation of a fitted model with another
+    vectorizer, c-TF-IDF or representation model. The clusters stay the same.
+
+    Parameters
+    ----------
+    topic_model
+        a fitted model.
+    texts
+        the texts the model was fitted on.
+    **kwargs
+        vectorizer_model, ctfidf_model, representation_model or top_n_words.
+
+    Returns
+    -------
+        the updated model.
+    """
+    topic_model.update_topics(texts, **kwargs)
+    return topic_model
+
+
+def make_online_model(
+    n_components: int = 5,
+    n_clusters: int = 50,
+    decay: float = 0.01,
+    model_name: str = MODEL,
+    **kwargs,
+) -> BERTopic:
+    """Creates a BERTopic model which can be updated with new texts. UMAP and
+    HDBSCAN are replaced by IncrementalPCA and MiniBatchKMeans, which support
+    partial fitting, and the bag-of-words is counted by an OnlineCountVectorizer.
+
+    Parameters
+    ----------
+    n_components, optional
+        number of dimensions of the reduced embeddings, by default 5
+    n_clusters, optional
+        number of topics, by default 50
+    decay, optional
+        how much the counts of the earlier texts decay with every update, by
+        default 0.01
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    **kwargs
+        other arguments of BERTopic or OnlineCountVectorizer (stop_words).
+
+    Returns
+    -------
+        a model which is not fitted yet.
+    """
+    stop_words = kwargs.pop("stop_words", None)
+    return BERTopic(
+        embedding_model=load_sentence_model(model_name),
+        umap_model=IncrementalPCA(n_components=n_components),
+        hdbscan_model=MiniBatchKMeans(n_clusters=n_clusters, random_state=0),
+        vectorizer_model=OnlineCountVectorizer(stop_words=stop_words, decay=decay),
+        **kwargs,
+    )
+
+
+def min_batch_size(topic_model: BERTopic) -> int:
+    """The smallest number of texts in one partial fit of an online model.
+    IncrementalPCA needs at least n_components texts in every batch and
+    MiniBatchKMeans at least n_clusters texts in the first one."""
+    size = getattr(topic_model.umap_model, "n_components", 1)
+    if topic_model.topics_ is None:
+        size = max(size, getattr(topic_model.hdbscan_model, "n_clusters", 1))
+    return size
+
+
+def partial_fit_topic_model(
+    topic_model: BERTopic,
+    texts: list,
+    model_name: str = MODEL,
+    cache: Path = CACHE,
+    batch_size: int = BATCH_SIZE,
+) -> list:
+    """Updates an online model with new texts batch by batch. The first batch
+    has at least min_batch_size texts and an undersized last batch is merged
+    into the one before it.
+
+    Parameters
+    ----------
+    topic_model
+        a model from make_online_model.
+    texts
+        a list of new texts.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+    batch_size, optional
+        number of texts in one partial fit, by default BATCH_SIZE
+
+    Returns
+    -------
+        the topic of every new text.
+
+    Raises
+    ------
+    ValueError
+        if there are fewer texts than min_batch_size.
+    """
+    size = min_batch_size(topic_model)
+    if len(texts) < size:
+        raise ValueError(f"At least {size} texts are needed, got {len(texts)}.")
+    embeddings = compute_embeddings(texts, model_name=model_name, cache=cache)
+    ends = list(range(max(batch_size, size), len(texts), batch_size)) + [len(texts)]
+    if len(ends) > 1 and ends[-1] - ends[-2] < size:
+        del ends[-2]
+    topics = []
+    start = 0
+    for end in ends:
+        topic_model.partial_fit(texts[start:end], embeddings[start:end])
+        ## topics_ holds the topics of the last batch only
+        topics.extend(topic_model.topics_)
+        start = end
+    return topics
+
+
+def update_topic_model(
+    path: Path,
+    df: pd.DataFrame,
+    topics_path: Path,
+    model_name: str = MODEL,
+    cache: Path = CACHE,
+    batch_size: int = BATCH_SIZE,
+    **kwargs,
+) -> pd.DataFrame:
+    """Updates a saved online model with the texts which do not have a topic
+    yet and appends their topics to a table. The model is created if it does
+    not exist. If there are too few new texts for one partial fit (compare
+    min_batch_size), nothing is updated and they are left for the next run.
+
+    Parameters
+    ----------
+    path
+        a path to the pickled model (it is overwritten).
+    df
+        a data frame with id and body columns, e.g. the whole corpus.
+    topics_path
+        a path to the CSV file with the id and the topic of every text.
+    model_name, optional
+        name of the sentence transformer, by default MODEL
+    cache, optional
+        a directory with the cached matrices, by default CACHE
+    batch_size, optional
+        number of texts in one partial fit, by default BATCH_SIZE
+    **kwargs
+        arguments of make_online_model for a new model.
+
+    Returns
+    -------
+        the new texts with their topics.
+    """
+    path, topics_path = Path(path), Path(topics_path)
+    if path.exists():
+        topic_model = BERTopic.load(
+            path, embedding_model=load_sentence_model(model_name)
+        )
+    else:
+        topic_model = make_online_model(model_name=model_name, **kwargs)
+    if topics_path.exists():
+        done = pd.read_csv(topics_path, usecols=["id"], dtype={"id": str})["id"]
+        df = df[~df["id"].astype(str).isin(done)]
+    size = min_batch_size(topic_model)
+    if len(df) < size:
+        if not df.empty:
+            print(
+                f"Only {len(df)} new texts, at least {size} are needed to update "
+                "the model. They are left for the next run."
+            )
+        return df.iloc[:0].assign(topic=pd.Series(dtype=int))
+    topics = partial_fit_topic_model(
+        topic_model,
+        list(df["body"]),
+        model_name=model_name,
+        cache=cache,
+        batch_size=batch_size,
+    )
+    ## The online models are only saved completely with pickle
+    topic_model.save(path, serialization="pickle", save_embedding_model=False)
+    new = df.assign(topic=topics)
+    new[["id", "topic"]].to_csv(
+        topics_path, mode="a", header=not topics_path.exists(), index=False
+    )
+    return new
@@ -0,0 +1,184 @@
+# %%
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prawcore.exceptions import Forbidden, NotFound, PrawcoreException
+
+# %%
+## Define globals
+## Errors which will not go away if we ask again (deleted or suspended accounts)
+PERMANENT_ERRORS = (NotFound, Forbidden, AttributeError)
+
+
+# %%
+## Define classes
+class AuthorCache:
+    """
+    A least-recently-used cache of author profiles. Every profile is fetched at
+    most once per ttl seconds, however many comments its author wrote. Failed
+    lookups are recorded as well: permanent ones (deleted or suspended accounts)
+    are cached like profiles, transient ones are only counted, so they are
+    tried again. The cache can be saved to and loaded from a JSON file, and it
+    is thread safe.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 100_000,
+        ttl: float = 7 * 24 * 60 * 60,
+        path: str | None = None,
+        partial_ok: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        maxsize, optional
+            the largest number of authors kept in the cache, by default 100_000
+        ttl, optional
+            number of seconds after which a profile is fetched again, by default a week
+        path, optional
+            a path to the JSON file the cache is loaded from and saved to, by default None
+        partial_ok, optional
+            True if the profiles fetched in bulk (without has_verified_email and
+            is_gold) are good enough, by default False
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.partial_ok = partial_ok
+        self.failures = {}
+        self.requests = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, name: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if time.time() - entry["fetched"] > self.ttl:
+                del self._entries[name]
+                return None
+            if not (entry["complete"] or self.partial_ok):
+                return None
+            self._entries.move_to_end(name)
+            return entry
+
+    def _store(self, name: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[name] = entry
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, redditor) -> dict | None:
+        """Returns the profile of the author, fetching it only on a cache miss.
+
+        Parameters
+        ----------
+        redditor
+            a praw.models.Redditor (e.g. comment.author) or None for deleted authors.
+
+        Returns
+        -------
+            a mapping with name, karma, created_utc (epoch), has_verified_email
+            and is_gold, or None if the profile is not available.
+        """
+        if redditor is None:
+            return None
+        entry = self._lookup(redditor.name)
+        if entry is not None:
+            return entry["profile"]
+        self.requests += 1
+        try:
+            profile = {
+                "name": redditor.name,
+                "karma": redditor.comment_karma,
+                "created_utc": redditor.created_utc,
+                "has_verified_email": redditor.has_verified_email,
+                "is_gold": redditor.is_gold,
+            }
+        except PERMANENT_ERRORS as error:
+            self.failures[redditor.name] = type(error).__name__
+            profile = None
+        except PrawcoreException as error:
+            self.failures[redditor.name] = type(error).__name__
+            return None
+        self._store(
+            redditor.name,
+            {"profile": profile, "fetched": time.time(), "complete": True},
+        )
+        return profile
+
+    def prefetch(self, reddit, authors: dict) -> None:
+        """Fetches the profiles of many authors at once (100 per request). The
+        bulk endpoint does not return has_verified_email and is_gold, so the
+        profiles are used only if the cache was created with partial_ok.
+
+        Parameters
+        ----------
+        reddit
+            an instance of praw.Reddit.
+        authors
+            a mapping from the author name to the author fullname (t2_ prefixed id).
+        """
+        if not self.partial_ok:
+            return
+        missing = [
+            fullname
+            for name, fullname in authors.items()
+            if fullname is not None and self._lookup(name) is None
+        ]
+        self.requests += (len(missing) + 99) // 100
+        try:
+            for redditor in reddit.redditors.partial_redditors(missing):
+                profile = {
+                    "name": redditor.name,
+                    "karma": redditor.comment_karma,
+                    "created_utc": redditor.created_utc,
+                    "has_verified_email": None,
+                    "is_gold": None,
+                }
+                self._store(
+                    redditor.name,
+                    {"profile": profile, "fetched": time.time(), "complete": False},
+                )
+        except PrawcoreException as error:
+            self.failures["prefetch"] = type(error).__name__
+
+    def load(self, path: str) -> None:
+        """Loads the profiles which did not expire from a JSON file.
+
+        Parameters
+        ----------
+        path
+            a path to the JSON file.
+        """
+        with open(path, "r") as file:
+            entries = json.load(file)
+        now = time.time()
+        for name, entry in entries.items():
+            if now - entry["fetched"] <= self.ttl:
+                self._store(name, entry)
+
+    def save(self, path: str | None = None) -> None:
+        """Saves the cache to a JSON file.
+
+        Parameters
+        ----------
+        path, optional
+            a path to the JSON file, by default the one given at creation.
+        """
+        path = path or self.path
+        with self._lock:
+            entries = dict(self._entries)
+        with open(path, "w") as file:
+            json.dump(entries, file)
@@ -0,0 +1,240 @@
+# %%
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from writers import make_writer
+
+
+# %%
+## Define classes
+class Checkpoint:
+    """
+    A small SQLite sidecar which stores the progress of a crawl, so it can be
+    stopped at any moment and resumed later. It keeps two kinds of records:
+    cursors (e.g. the last `after` date collected for an output file) and
+    finished items (e.g. the ids of submissions whose comments were written).
+    Every change is committed at once (or at the end of a batch), so whatever
+    is in the store survived.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path
+            a path to the SQLite file. It is created if it does not exist.
+        """
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cursors (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS items "
+            "(kind TEXT, id TEXT, value TEXT, PRIMARY KEY (kind, id))"
+        )
+        self._connection.commit()
+        self._batch = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """Closes the connection to the SQLite file."""
+        self._connection.close()
+
+    @contextmanager
+    def batch(self):
+        """Groups the changes made inside the with-block into one transaction, so
+        either all of them are stored or none of them."""
+        self._batch = True
+        try:
+            yield self
+        except BaseException:
+            self._connection.rollback()
+            raise
+        else:
+            self._connection.commit()
+        finally:
+            self._batch = False
+
+    def _commit(self) -> None:
+        if not self._batch:
+            self._connection.commit()
+
+    def get(self, key: str, default=None):
+        """Returns the value of a cursor.
+
+        Parameters
+        ----------
+        key
+            name of the cursor.
+        default, optional
+            value returned if the cursor was never set, by default None
+        """
+        row = self._connection.execute(
+            "SELECT value FROM cursors WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        """Sets the value of a cursor.
+
+        Parameters
+        ----------
+        key
+            name of the cursor.
+        value
+            any JSON serializable value.
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO cursors VALUES (?, ?)", (key, json.dumps(value))
+        )
+        self._commit()
+
+    def mark_done(self, kind: str, item_id: str, value=None) -> None:
+        """Records that an item was finished.
+
+        Parameters
+        ----------
+        kind
+            kind of the item, e.g. "submission".
+        item_id
+            id of the item.
+        value, optional
+            any JSON serializable value stored with the item, by default None
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+            (kind, item_id, json.dumps(value)),
+        )
+        self._commit()
+
+    def is_done(self, kind: str, item_id: str) -> bool:
+        """Checks whether an item was finished.
+
+        Parameters
+        ----------
+        kind
+            kind of the item, e.g. "submission".
+        item_id
+            id of the item.
+        """
+        row = self._connection.execute(
+            "SELECT 1 FROM items WHERE kind = ? AND id = ?", (kind, item_id)
+        ).fetchone()
+        return row is not None
+
+    def done(self, kind: str) -> dict:
+        """Returns all the finished items of a given kind.
+
+        Parameters
+        ----------
+        kind
+            kind of the items, e.g. "submission".
+
+        Returns
+        -------
+            a mapping from the item id to the value stored with it.
+        """
+        rows = self._connection.execute(
+            "SELECT id, value FROM items WHERE kind = ?", (kind,)
+        )
+        return {item_id: json.loads(value) for item_id, value in rows}
+
+    def clear(self, prefix: str = "") -> None:
+        """Removes the cursors and the items which start with the prefix.
+
+        Parameters
+        ----------
+        prefix, optional
+            prefix of the cursor names and item kinds, by default "" (everything)
+        """
+        self._connection.execute(
+            "DELETE FROM cursors WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        )
+        self._connection.execute(
+            "DELETE FROM items WHERE substr(kind, 1, ?) = ?", (len(prefix), prefix)
+        )
+        self._commit()
+
+
+# %%
+## Define functions
+def open_output(
+    path: str,
+    checkpoint: Checkpoint,
+    resume: bool = False,
+    format: str = "jsonl",
+    **kwargs,
+):
+    """Opens a writer for the output of a crawl. Without resume it starts from
+    scratch and forgets the old progress. With resume it cuts off whatever was
+    written to a JSON line file after the last committed offset (a half-written
+    batch from a crash), or removes the Parquet files which were not committed,
+    and appends to the output.
+
+    Parameters
+    ----------
+    path
+        a path to the output file.
+    checkpoint
+        a checkpoint store of the crawl.
+    resume, optional
+        True if the crawl continues from the checkpoint, by default False
+    format, optional
+        either "jsonl" or "parquet", by default "jsonl"
+    **kwargs
+        passed to make_writer.
+
+    Returns
+    -------
+        a tuple with a writer and the last committed cursor (None if there is
+        nothing to resume).
+    """
+    path = str(path)
+    if not resume:
+        file = make_writer(format, path, mode="w", **kwargs)
+        checkpoint.clear(prefix=file.name)
+        return file, None
+    state = checkpoint.get(path)
+    if format == "jsonl" and state is not None and os.path.exists(path):
+        os.truncate(path, state["offset"])
+    file = make_writer(format, path, mode="a", **kwargs)
+    state = checkpoint.get(file.name, {"cursor": None})
+    if format == "parquet" and isinstance(state.get("offset"), dict):
+        file.rollback(state["offset"])
+    return file, state["cursor"]
+
+
+def commit_output(file, checkpoint: Checkpoint, cursor=None, done=()) -> None:
+    """Records how much of the output is complete together with the cursor the
+    crawl should continue from and the items it finished. It happens in one
+    transaction once the rows written so far are on disk (at once for JSON
+    lines, after the next flush of the buffer for Parquet).
+
+    Parameters
+    ----------
+    file
+        a writer returned by open_output.
+    checkpoint
+        a checkpoint store of the crawl.
+    cursor, optional
+        any JSON serializable value, by default None
+    done, optional
+        a list of tuples (kind, item_id, value) passed to mark_done, by default ()
+    """
+
+    def commit():
+        with checkpoint.batch():
+            checkpoint.set(file.name, {"offset": file.tell(), "cursor": cursor})
+            for kind, item_id, value in done:
+                checkpoint.mark_done(kind, item_id, value)
+
+    file.defer(commit)
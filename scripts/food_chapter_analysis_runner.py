@@ -0,0 +1,351 @@
+# %%
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from itertools import combinations
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import levene, median_test
+
+from food_chapter_embedding_store import EmbeddingStore
+from food_chapter_permutation import (
+    median_difference,
+    permutation_test,
+    spread_difference,
+)
+from food_chapter_sentiment_table import REDUCERS, aggregate, load_chunks
+from food_chapter_spread import cosine_spread
+
+# %%
+## Define globals
+ROOT = Path(__file__).parent.parent
+DATA = ROOT / "data"
+PROC = DATA / "processed"
+
+## The COM-B categories and the texts which belong to them
+CATEGORIES = {
+    "motivation": "mot_refl > 0 | mot_auto > 0",
+    "capabilities": "cap_psychological > 0 | cap_physical > 0",
+    "opportunities": "opp_physical > 0 | opp_social > 0",
+}
+COUNTRIES = ["poland", "portugal", "uk"]
+
+
+# %%
+## Define classes
+@dataclass
+class Analysis:
+    """
+    One test of a metric between the countries in a COM-B category. The
+    omnibus tests (levene, median) compare all the countries at once, the
+    permutation tests compare every pair of them.
+    """
+
+    category: str
+    metric: str
+    test: str
+    countries: list = field(default_factory=lambda: list(COUNTRIES))
+
+
+## The tests run by food_chapter_analyze_sentiment.py and food_chapter_analyze_embeddings_spread.py
+SPEC = [
+    Analysis("motivation", "distances", "levene"),
+    Analysis("capabilities", "distances", "levene", countries=["poland", "uk"]),
+    Analysis("opportunities", "distances", "levene"),
+    Analysis("opportunities", "distances", "permutation_spread"),
+    Analysis("motivation", "sentiment", "median"),
+    Analysis("capabilities", "sentiment", "median"),
+    Analysis("opportunities", "sentiment", "median"),
+    Analysis("motivation", "sentiment", "permutation_median"),
+    Analysis("opportunities", "sentiment", "permutation_median"),
+]
+
+
+# %%
+## Define functions
+def load_sentiment(
+    path: str = PROC / "food_texts_sentiment.parquet", reducer="argmax_mean"
+) -> pd.DataFrame:
+    """Loads the sentiment of the texts from the chunk-level table. By default,
+    the sentiment of a text is the mean of the most likely label of its chunks
+    (positive 1, negative -1, neutral 0) weighted by its score.
+
+    Parameters
+    ----------
+    path, optional
+        a path to the Parquet table (or the older JSON line file), by default
+        PROC / "food_texts_sentiment.parquet"
+    reducer, optional
+        a name from REDUCERS of food_chapter_sentiment_table.py or a function,
+        by default "argmax_mean"
+
+    Returns
+    -------
+        a data frame with id and sentiment columns.
+    """
+    return aggregate(load_chunks(path), reducer=reducer)
+
+
+def compute_distances(
+    df: pd.DataFrame, store: EmbeddingStore, by="country"
+) -> pd.DataFrame:
+    """Computes the cosine distance of every text to the centroid of its country
+    (or any other group) block by block from the memory-mapped matrix.
+
+    Parameters
+    ----------
+    df
+        a data frame with id and country columns.
+    store
+        an embedding store with the vectors of the texts.
+    by, optional
+        a column or a list of columns to group by, by default "country"
+
+    Returns
+    -------
+        a data frame with id and distances columns.
+    """
+    df = df[df["id"].isin(store.index["id"])].drop_duplicates("id")
+    distances = cosine_spread(store, df, by=by)
+    return pd.DataFrame({"id": df["id"].to_numpy(), "distances": distances.to_numpy()})
+
+
+def load_data(
+    sentiment: str = PROC / "food_texts_sentiment.parquet",
+    embeddings: str = PROC / "food_texts_embeddings",
+    reducer="argmax_mean",
+) -> pd.DataFrame:
+    """Loads the texts and joins them with their sentiment and semantic spread.
+
+    Parameters
+    ----------
+    sentiment, optional
+        a path to the table with the sentiment of the chunks, by default PROC / "food_texts_sentiment.parquet"
+    embeddings, optional
+        a path to the embedding store, by default PROC / "food_texts_embeddings"
+    reducer, optional
+        how the sentiment of the chunks is aggregated, by default "argmax_mean"
+
+    Returns
+    -------
+        a data frame with the texts, their sentiment and distances columns
+        (NaN where a metric is missing).
+    """
+    df = pd.read_csv(PROC / "food_texts.csv", index_col=None, dtype={"id": str})
+    df = df.drop_duplicates("id")
+    df = pd.merge(df, load_sentiment(sentiment, reducer=reducer), on="id", how="left")
+    distances = compute_distances(df, EmbeddingStore(embeddings))
+    return pd.merge(df, distances, on="id", how="left")
+
+
+def run_analysis(
+    analysis: Analysis,
+    df: pd.DataFrame,
+    n_permutations: int = 10000,
+    rng=None,
+) -> list:
+    """Runs one analysis.
+
+    Parameters
+    ----------
+    analysis
+        the category, metric, test and countries.
+    df
+        a data frame with the texts of the category.
+    n_permutations, optional
+        number of permutations of the permutation tests, by default 10000
+    rng, optional
+        a random generator or a seed of the permutation tests, by default None
+
+    Returns
+    -------
+        a list of mappings, one row of the results table per comparison.
+    """
+    df = df.dropna(subset=[analysis.metric])
+    groups = {
+        country: df.loc[df["country"] == country, analysis.metric].to_numpy()
+        for country in analysis.countries
+    }
+    row = asdict(analysis)
+    del row["countries"]
+    rows = []
+    if analysis.test == "levene":
+        stat, pvalue = levene(*groups.values(), center="trimmed")
+        rows.append(
+            {
+                "group_a": ",".join(groups),
+                "group_b": None,
+                "statistic": stat,
+                "pvalue": pvalue,
+                "n": sum(len(values) for values in groups.values()),
+            }
+        )
+    elif analysis.test == "median":
+        ## Mood's median test needs at least 10 texts per country
+        groups = {
+            country: values for country, values in groups.items() if len(values) >= 10
+        }
+        stat, pvalue, _, _ = median_test(*groups.values())
+        rows.append(
+            {
+                "group_a": ",".join(groups),
+                "group_b": None,
+                "statistic": stat,
+                "pvalue": pvalue,
+                "n": sum(len(values) for values in groups.values()),
+            }
+        )
+    elif analysis.test in ("permutation_spread", "permutation_median"):
+        if analysis.test == "permutation_spread":
+            statistic, alternative = spread_difference, "greater"
+        else:
+            statistic, alternative = median_difference, "two-sided"
+        rng = np.random.default_rng(rng)
+        for label_a, label_b in combinations(analysis.countries, 2):
+            stat, pvalue = permutation_test(
+                groups[label_a],
+                groups[label_b],
+                statistic=statistic,
+                n_permutations=n_permutations,
+                rng=rng,
+                alternative=alternative,
+            )
+            rows.append(
+                {
+                    "group_a": label_a,
+                    "group_b": label_b,
+                    "statistic": stat,
+                    "pvalue": pvalue,
+                    "n": len(groups[label_a]) + len(groups[label_b]),
+                }
+            )
+    else:
+        raise ValueError(f"Unknown test {analysis.test}")
+    return [{**row, **result} for result in rows]
+
+
+def adjust_pvalues(pvalues, method: str = "bonferroni") -> np.ndarray:
+    """Corrects the p-values of a family of comparisons.
+
+    Parameters
+    ----------
+    pvalues
+        the p-values of the family.
+    method, optional
+        "bonferroni", "holm" or "fdr_bh" (Benjamini-Hochberg), by default "bonferroni"
+
+    Returns
+    -------
+        the adjusted p-values (capped at 1).
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    n = len(pvalues)
+    if method == "bonferroni":
+        return np.minimum(pvalues * n, 1.0)
+    order = np.argsort(pvalues)
+    adjusted = np.empty(n)
+    if method == "holm":
+        steps = np.maximum.accumulate(pvalues[order] * (n - np.arange(n)))
+    elif method == "fdr_bh":
+        steps = pvalues[order] * n / np.arange(1, n + 1)
+        steps = np.minimum.accumulate(steps[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown method {method}")
+    adjusted[order] = np.minimum(steps, 1.0)
+    return adjusted
+
+
+def run_spec(
+    df: pd.DataFrame,
+    spec: list = SPEC,
+    n_permutations: int = 10000,
+    seed: int = 8710,
+    processes: int = 1,
+    method: str = "bonferroni",
+    alpha: float = 0.05,
+) -> pd.DataFrame:
+    """Runs all the analyses of a spec and collects them in one table. The
+    p-values are corrected within every family of comparisons (the pairs of
+    countries of one category, metric and test).
+
+    Parameters
+    ----------
+    df
+        a data frame from load_data.
+    spec, optional
+        a list of analyses, by default SPEC
+    n_permutations, optional
+        number of permutations of the permutation tests, by default 10000
+    seed, optional
+        seed of the permutation tests, every analysis gets its own stream, by default 8710
+    processes, optional
+        number of analyses run at the same time in separate processes, by default 1
+    method, optional
+        "bonferroni", "holm" or "fdr_bh", by default "bonferroni"
+    alpha, optional
+        the significance level of a family, by default 0.05
+
+    Returns
+    -------
+        a tidy data frame with one row per comparison.
+    """
+    subsets = [df.query(CATEGORIES[analysis.category]) for analysis in spec]
+    seeds = np.random.SeedSequence(seed).spawn(len(spec))
+    args = [
+        (analysis, subset, n_permutations, np.random.default_rng(seq))
+        for analysis, subset, seq in zip(spec, subsets, seeds)
+    ]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(run_analysis, *zip(*args)))
+    else:
+        results = [run_analysis(*arg) for arg in args]
+
+    table = pd.DataFrame([row for rows in results for row in rows])
+    table["pvalue_adj"] = table.groupby(["category", "metric", "test"])[
+        "pvalue"
+    ].transform(lambda pvalues: adjust_pvalues(pvalues, method=method))
+    table["significant"] = table["pvalue_adj"] < alpha
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the tests of the sentiment and semantic spread for every COM-B category."
+    )
+    parser.add_argument("--output", default=PROC / "food_texts_tests.csv")
+    parser.add_argument("--n-permutations", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=8710)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of analyses run at the same time",
+    )
+    parser.add_argument(
+        "--correction", choices=["bonferroni", "holm", "fdr_bh"], default="bonferroni"
+    )
+    parser.add_argument(
+        "--reducer",
+        choices=list(REDUCERS),
+        default="argmax_mean",
+        help="how the sentiment of the chunks of a text is aggregated",
+    )
+    args = parser.parse_args()
+    df = load_data(reducer=args.reducer)
+    table = run_spec(
+        df,
+        n_permutations=args.n_permutations,
+        seed=args.seed,
+        processes=args.processes,
+        method=args.correction,
+    )
+    table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+
+
+# %%
+if __name__ == "__main__":
+    main()
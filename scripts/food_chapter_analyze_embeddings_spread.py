@@ -1,12 +1,17 @@
 # %%
-import json
 import pandas as pd
 from pathlib import Path
 import matplotlib.pyplot as plt
 from matplotlib import rc
 import numpy as np
-from scipy.spatial.distance import cdist
 from scipy.stats import levene
+from food_chapter_analysis_runner import compute_distances
+from food_chapter_embedding_store import EmbeddingStore
+from food_chapter_permutation import (
+    PermutationResult,
+    permutation_test,
+    spread_difference,
+)
 
 # %%
 ## Define globals
@@ -102,7 +107,9 @@ def permutation_test_pairwise(
     label_b: str,
     num_permutations=10000,
     alpha_adj=0.0167,
-):
+    rng=rng,
+    processes: int = 1,
+) -> PermutationResult:
     """
     Runs a non-parametric permutation test to compare the variances of two distance groups.
 
@@ -118,65 +125,45 @@ def permutation_test_pairwise(
         number of permutations, by default 10000
     alpha_adj, optional
         adjustment of the p value, by default 0.0167
+    rng, optional
+        a random generator, by default rng
+    processes, optional
+        number of processes the permutations are spread over, by default 1
+
+    Returns
+    -------
+        a PermutationResult with the observed difference of the mean absolute deviations and the p-value.
     """
-    group_a = df.query("country == @label_a")["distances"].tolist()
-    group_b = df.query("country == @label_b")["distances"].tolist()
-    dev_a = np.abs(group_a - np.median(group_a))
-    dev_b = np.abs(group_b - np.median(group_b))
-    observed_diff = np.abs(np.mean(dev_a) - np.mean(dev_b))
-
-    # Combine the data
-    combined = np.concatenate([group_a, group_b])
-    n_a = len(group_a)
-
-    extreme_count = 0
-    for _ in range(num_permutations):
-        # Shuffle the labels
-        shuffled = rng.permutation(combined)
-        # Split into fake groups
-        fake_a = shuffled[:n_a]
-        fake_b = shuffled[n_a:]
-        dev_fake_a = np.abs(fake_a - np.median(fake_a))
-        dev_fake_b = np.abs(fake_b - np.median(fake_b))
-
-        fake_diff = np.abs(np.mean(dev_fake_a) - np.mean(dev_fake_b))
-        if fake_diff >= observed_diff:
-            extreme_count += 1
-
-    # p-value is the proportion of shuffles that produced a difference as large or larger
-    p_val = extreme_count / num_permutations
-    status = "SIGNIFICANT" if p_val < alpha_adj else "NOT SIGNIFICANT"
-
-    print(f"{label_a} vs {label_b} (Permutation):")
-    print(f"  Observed Mean Diff: {observed_diff}")
-    print(f"  p-value:            {p_val} ({status})")
+    group_a = df.query("country == @label_a")["distances"].to_numpy()
+    group_b = df.query("country == @label_b")["distances"].to_numpy()
+    observed_diff, p_val = permutation_test(
+        group_a,
+        group_b,
+        statistic=spread_difference,
+        n_permutations=num_permutations,
+        rng=rng,
+        processes=processes,
+    )
+    return PermutationResult(
+        label_a=label_a,
+        label_b=label_b,
+        statistic="Mean Diff",
+        observed=observed_diff,
+        pvalue=p_val,
+        n_permutations=num_permutations,
+        alpha=alpha_adj,
+    )
 
 
 # %%
 ## Load data
-df = pd.read_csv(PROC / "food_texts.csv", index_col=None)
-
-embeddings_lst = []
-for line in open(PROC / "food_texts_embeddings.jsonl", "r"):
-    tmp = json.loads(line)
-    embeddings_lst.append({"id": tmp["id"], "embeddings": tmp["embeddings"]})
+df = pd.read_csv(PROC / "food_texts.csv", index_col=None, dtype={"id": str})
 
-df_embeddings = pd.DataFrame.from_dict(embeddings_lst)
-df = pd.merge(df, df_embeddings, on="id").drop_duplicates("id")
+store = EmbeddingStore(PROC / "food_texts_embeddings")
+df = df[df["id"].isin(store.index["id"])].drop_duplicates("id")
 # %%
-## Compute PCA on normalized embeddings
-df_lst = []
-for _, tmp in df.groupby("country"):
-    vectors = np.array(tmp["embeddings"].tolist())
-    centroid = np.mean(vectors, axis=0, keepdims=True)
-    ## Calculate cosine distance
-    distances_2d = cdist(vectors, centroid, metric="cosine")
-    cosine_distances = distances_2d.flatten()
-    cosine_df = pd.DataFrame(cosine_distances, columns=["distances"])
-    tmp = tmp.reset_index(drop=True).join(cosine_df)
-    df_lst.append(tmp)
-
-df = pd.concat(df_lst)
+## Compute the cosine distance of every text to the centroid of its country
+df = pd.merge(df, compute_distances(df, store), on="id")
 
 # %%
 ## MOTIVATION
@@ -216,7 +203,7 @@ levene_test(df_opp, countries=["poland", "portugal", "uk"])
 
 # %%
 ## Premutation test
-permutation_test_pairwise(df_opp, label_a="poland", label_b="uk")
-permutation_test_pairwise(df_opp, label_a="poland", label_b="portugal")
-permutation_test_pairwise(df_opp, label_a="portugal", label_b="uk")
+print(permutation_test_pairwise(df_opp, label_a="poland", label_b="uk"))
+print(permutation_test_pairwise(df_opp, label_a="poland", label_b="portugal"))
+print(permutation_test_pairwise(df_opp, label_a="portugal", label_b="uk"))
 # %%
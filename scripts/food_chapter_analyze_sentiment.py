@@ -1,11 +1,16 @@
 # %%
-import json
 import pandas as pd
 from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import rc
-from scipy.stats import median_test, permutation_test
+from scipy.stats import median_test
+from food_chapter_analysis_runner import load_sentiment
+from food_chapter_permutation import (
+    PermutationResult,
+    median_difference,
+    permutation_test,
+)
 
 # %%
 ## Define globals
@@ -14,8 +19,6 @@ DATA = ROOT / "data"
 PROC = DATA / "processed"
 PNG = ROOT / "png"
 
-map_sentiment = {"positive": 1, "negative": -1}
-
 COLORS = {"yellow": "#E6B830", "blue": "#A5C9E6", "green": "#73C0C1"}
 font = {"size": 10}
 
@@ -92,7 +95,7 @@ def test_median(df: pd.DataFrame) -> None:
         if len(tmp) < 10:
             continue
         dct[_] = tmp["sentiment"].tolist()
-        print(f"{_} median = {np.median(tmp["sentiment"].tolist())}")
+        print(f"{_} median = {np.median(tmp['sentiment'].tolist())}")
 
     results = median_test(*dct.values())
     print(
@@ -108,63 +111,59 @@ def run_pairwise_median_permutation(
     n_resamples: int = 10000,
     alpha_adj: float = 0.0167,
     rng=rng,
-):
+    processes: int = 1,
+) -> PermutationResult:
     """
-    Runs a non-parametric permutation test to compare the medians of two distance groups.
+    Runs a non-parametric permutation test to compare the medians of two sentiment groups.
 
     Parameters
     ----------
     df
-        _description_
+        a data frame with country and sentiment columns.
     label_a
-        _description_
+        a name of a country
     label_b
-        _description_
+        a name of a country
     n_resamples, optional
-        _description_, by default 10000
+        number of permutations, by default 10000
     alpha_adj, optional
-        _description_, by default 0.0167
+        adjustment of the p value, by default 0.0167
+    rng, optional
+        a random generator or a seed, by default rng
+    processes, optional
+        number of processes the permutations are spread over, by default 1
 
     Returns
     -------
-        _description_
+        a PermutationResult with the observed |Mdn_A - Mdn_B| and the p-value.
     """
-    group_a = df.query("country == @label_a")["sentiment"].tolist()
-    group_b = df.query("country == @label_b")["sentiment"].tolist()
-    # Run the exact or randomized permutation test
-    res = permutation_test(
-        (group_a, group_b),
-        statistic=lambda x, y: np.abs(np.median(x) - np.median(y)),
-        permutation_type="independent",
-        n_resamples=n_resamples,
-        random_state=rng,
+    group_a = df.query("country == @label_a")["sentiment"].to_numpy()
+    group_b = df.query("country == @label_b")["sentiment"].to_numpy()
+    # Run the randomized permutation test with the p-value of scipy.stats.permutation_test
+    obs_diff, p_val = permutation_test(
+        group_a,
+        group_b,
+        statistic=median_difference,
+        n_permutations=n_resamples,
+        rng=rng,
+        processes=processes,
+        alternative="two-sided",
+    )
+    return PermutationResult(
+        label_a=label_a,
+        label_b=label_b,
+        statistic="|Mdn_A - Mdn_B|",
+        observed=obs_diff,
+        pvalue=p_val,
+        n_permutations=n_resamples,
+        alpha=alpha_adj,
     )
-
-    obs_diff = np.abs(np.median(group_a) - np.median(group_b))
-    p_val = res.pvalue
-    status = "SIGNIFICANT" if p_val < alpha_adj else "NOT SIGNIFICANT"
-    print("======Post Hoc======")
-    print(f"{label_a} vs {label_b}:")
-    print(f"  Observed |Mdn_A - Mdn_B| = {obs_diff}")
-    print(f"  p-value = {p_val} ({status})")
-    print("=====================")
 
 
 # %%
 ## Load data
-df = pd.read_csv(PROC / "food_texts.csv", index_col=None)
-sentiment_lst = []
-for line in open(PROC / "food_texts_sentiment.jsonl", "r"):
-    tmp = json.loads(line)
-    sentiment = [max(item, key=lambda x: x["score"]) for item in tmp["sentiment"]]
-    sentiment = [
-        map_sentiment.get(item["label"].lower(), 0) * item["score"]
-        for item in sentiment
-    ]
-    sentiment = np.mean(sentiment)
-    sentiment_lst.append({"id": tmp["id"], "sentiment": sentiment})
-
-df_sentiment = pd.DataFrame.from_dict(sentiment_lst)
+df = pd.read_csv(PROC / "food_texts.csv", index_col=None, dtype={"id": str})
+df_sentiment = load_sentiment(PROC / "food_texts_sentiment.parquet")
 df = pd.merge(df, df_sentiment, on="id").drop_duplicates("id")
 # %%
 ## MOTIVATION
@@ -176,9 +175,9 @@ fig.savefig(PNG / "motivation_sentiment.png", dpi=200)
 # %%
 ## Omnibus test Motivation
 test_median(df_mot)
-run_pairwise_median_permutation(df=df_mot, label_a="poland", label_b="uk")
-run_pairwise_median_permutation(df=df_mot, label_a="poland", label_b="portugal")
-run_pairwise_median_permutation(df=df_mot, label_a="uk", label_b="portugal")
+print(run_pairwise_median_permutation(df=df_mot, label_a="poland", label_b="uk"))
+print(run_pairwise_median_permutation(df=df_mot, label_a="poland", label_b="portugal"))
+print(run_pairwise_median_permutation(df=df_mot, label_a="uk", label_b="portugal"))
 
 # %%
 ## CAPABILITIES
@@ -209,7 +208,7 @@ fig.savefig(PNG / "opportunities_sentiment.png", dpi=200)
 # %%
 ## Omnibus test for Social Opportunities
 test_median(df_opp)
-run_pairwise_median_permutation(df=df_opp, label_a="poland", label_b="uk")
-run_pairwise_median_permutation(df=df_opp, label_a="poland", label_b="portugal")
-run_pairwise_median_permutation(df=df_opp, label_a="uk", label_b="portugal")
+print(run_pairwise_median_permutation(df=df_opp, label_a="poland", label_b="uk"))
+print(run_pairwise_median_permutation(df=df_opp, label_a="poland", label_b="portugal"))
+print(run_pairwise_median_permutation(df=df_opp, label_a="uk", label_b="portugal"))
 # %%
@@ -0,0 +1,122 @@
+# %%
+import io
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+# %%
+## Define globals
+ROOT = Path(__file__).parent.parent
+DATA = ROOT / "data"
+PROC = DATA / "processed"
+## Number of ids looked up in a single query
+QUERY_SIZE = 500
+
+
+# %%
+## Define functions
+def encode(value) -> tuple:
+    if isinstance(value, np.ndarray):
+        buffer = io.BytesIO()
+        np.save(buffer, value, allow_pickle=False)
+        return "npy", buffer.getvalue()
+    return "json", json.dumps(value).encode("utf-8")
+
+
+def decode(format: str, value: bytes):
+    if format == "npy":
+        return np.load(io.BytesIO(value), allow_pickle=False)
+    return json.loads(value)
+
+
+# %%
+## Define classes
+class TextCache:
+    """
+    A persistent cache of the results computed for every text (e.g. its
+    embedding or the sentiment of its chunks). A result is keyed by the text id
+    (the blake2b hash of the body from food_chapter_preprocessing.py, so a
+    changed text gets a new id), the name of the model and the chunking
+    parameters. Reruns compute only the texts which are missing. Arrays are
+    stored as .npy bytes, everything else as JSON.
+    """
+
+    def __init__(self, path: str = PROC / "food_texts_cache.sqlite"):
+        """
+        Parameters
+        ----------
+        path, optional
+            a path to the SQLite file, by default PROC / "food_texts_cache.sqlite"
+        """
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (id TEXT, model TEXT, params TEXT, "
+            "format TEXT, value BLOB, PRIMARY KEY (id, model, params))"
+        )
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """Closes the connection to the SQLite file."""
+        self._connection.close()
+
+    def get_many(self, ids, model: str, params: dict) -> dict:
+        """Returns the cached results of the given texts.
+
+        Parameters
+        ----------
+        ids
+            a list of text ids.
+        model
+            name of the model.
+        params
+            a mapping with the chunking parameters, e.g. {"max_length": 512}.
+
+        Returns
+        -------
+            a mapping from the text id to its result. The missing texts are left out.
+        """
+        ## Give the results back under the ids of the caller
+        lookup = {str(id_): id_ for id_ in ids}
+        ids = list(lookup)
+        params = json.dumps(params, sort_keys=True)
+        results = {}
+        for start in range(0, len(ids), QUERY_SIZE):
+            batch = ids[start : start + QUERY_SIZE]
+            rows = self._connection.execute(
+                "SELECT id, format, value FROM results WHERE model = ? AND params = ? "
+                f"AND id IN ({', '.join('?' * len(batch))})",
+                (model, params, *batch),
+            )
+            for id_, format, value in rows:
+                results[lookup[id_]] = decode(format, value)
+        return results
+
+    def put_many(self, results: dict, model: str, params: dict) -> None:
+        """Stores the results of many texts in one transaction.
+
+        Parameters
+        ----------
+        results
+            a mapping from the text id to its result (an array or any JSON serializable value).
+        model
+            name of the model.
+        params
+            a mapping with the chunking parameters, e.g. {"max_length": 512}.
+        """
+        params = json.dumps(params, sort_keys=True)
+        rows = [
+            (str(id_), model, params, *encode(value)) for id_, value in results.items()
+        ]
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+            )
@@ -0,0 +1,197 @@
+# %%
+from nltk.tokenize import sent_tokenize
+
+from food_chapter_cache import TextCache
+
+# %%
+## Define globals
+LANGUAGE_MAP = {"uk": "English", "poland": "Polish", "portugal": "Portuguese"}
+
+
+# %%
+## Define functions
+def split_sentences(text: str, country: str = "uk") -> list:
+    """Splits a text into sentences with the NLTK tokenizer of its language.
+
+    Parameters
+    ----------
+    text
+        the input text to be split.
+    country, optional
+        the country code to determine the sentence tokenizer to use, by default "uk"
+
+    Returns
+    -------
+        a list of sentences.
+    """
+    language = LANGUAGE_MAP.get(country.lower(), "English")
+    return sent_tokenize(text, language=language)
+
+
+def merge_sentences(
+    sentences: list, lengths: list, max_length: int, sep: int = 1
+) -> list:
+    """Greedily merges consecutive sentences into chunks whose length does not
+    exceed max_length. The length of the current chunk is kept as a running sum,
+    so every sentence is looked at once. A sentence which is longer than
+    max_length on its own becomes a chunk of its own.
+
+    Parameters
+    ----------
+    sentences
+        a list of sentences.
+    lengths
+        the length of every sentence (characters or tokens).
+    max_length
+        the maximum length of each chunk.
+    sep, optional
+        the length of the separator between two sentences, by default 1 (a space)
+
+    Returns
+    -------
+        a list of chunks.
+    """
+    chunks = []
+    current_chunk = []
+    current_length = 0
+
+    for sent, length in zip(sentences, lengths):
+        ## The same test as len(" ".join(current_chunk + [sent])) <= max_length
+        if current_length + (sep if current_chunk else 0) + length <= max_length:
+            current_length += (sep if current_chunk else 0) + length
+            current_chunk.append(sent)
+        else:
+            chunks.append(" ".join(current_chunk))
+            current_chunk = [sent]
+            current_length = length
+
+    if current_chunk:
+        chunks.append(" ".join(current_chunk))
+
+    return chunks
+
+
+def split_text(
+    text: str, country: str = "uk", max_length: int = 512, tokenizer=None
+) -> list:
+    """Splits the input text into chunks of a specified maximum length.
+
+    Parameters
+    ----------
+    text
+        the input text to be split.
+    country, optional
+        the country code to determine the sentence tokenizer to use, by default "uk"
+    max_length, optional
+        the maximum length of each chunk, by default 512
+    tokenizer, optional
+        a (fast) Hugging Face tokenizer. If it is given, the length is counted in
+        the tokens of the model (without the special tokens) instead of characters,
+        by default None
+
+    Returns
+    -------
+        a list of text chunks.
+    """
+    sentences = split_sentences(text, country=country)
+    if tokenizer is None:
+        lengths = [len(sent) for sent in sentences]
+        return merge_sentences(sentences, lengths, max_length=max_length)
+    if not sentences:
+        return []
+    input_ids = tokenizer(sentences, add_special_tokens=False)["input_ids"]
+    lengths = [len(ids) for ids in input_ids]
+    max_length = max_length - tokenizer.num_special_tokens_to_add()
+    return merge_sentences(sentences, lengths, max_length=max_length, sep=0)
+
+
+# %%
+## Define classes
+class Chunker:
+    """
+    Splits texts into chunks and remembers the chunks of every text id, in
+    memory and (optionally) in a TextCache, so the sentiment and the embedding
+    pipelines split the corpus only once.
+    """
+
+    def __init__(
+        self,
+        max_length: int = 512,
+        tokenizer=None,
+        cache: TextCache | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        max_length, optional
+            the maximum length of each chunk, by default 512
+        tokenizer, optional
+            a (fast) Hugging Face tokenizer to count the length in tokens, by
+            default None (characters)
+        cache, optional
+            a persistent cache of the chunks, by default None
+        """
+        self.max_length = max_length
+        self.tokenizer = tokenizer
+        self.cache = cache
+        self._memo = {}
+
+    @property
+    def params(self) -> dict:
+        """The chunking parameters, a part of the keys of the cached results."""
+        if self.tokenizer is None:
+            return {"max_length": self.max_length}
+        return {"max_length": self.max_length, "tokenizer": self.tokenizer.name_or_path}
+
+    def split(self, text: str, country: str = "uk", id_=None) -> list:
+        """Splits a text into chunks, reusing the chunks of the same text id.
+
+        Parameters
+        ----------
+        text
+            the input text to be split.
+        country, optional
+            the country code to determine the sentence tokenizer to use, by default "uk"
+        id_, optional
+            the text id, by default None (not memoized)
+
+        Returns
+        -------
+            a list of text chunks.
+        """
+        if id_ is not None and (id_, country) in self._memo:
+            return self._memo[id_, country]
+        chunks = split_text(
+            text, country=country, max_length=self.max_length, tokenizer=self.tokenizer
+        )
+        if id_ is not None:
+            self._memo[id_, country] = chunks
+        return chunks
+
+    def split_many(self, texts: dict, country: str = "uk") -> dict:
+        """Splits many texts of a country into chunks. The texts which were split
+        before are taken from memory or from the cache.
+
+        Parameters
+        ----------
+        texts
+            a mapping from the text id to the text.
+        country, optional
+            the country code to determine the sentence tokenizer to use, by default "uk"
+
+        Returns
+        -------
+            a mapping from the text id to a list of text chunks.
+        """
+        ## The sentences are split by the tokenizer of the language of the country
+        params = {**self.params, "country": country}
+        missing = [_ for _ in texts if (_, country) not in self._memo]
+        if self.cache is not None and missing:
+            cached = self.cache.get_many(missing, model="chunks", params=params)
+            for _, chunks in cached.items():
+                self._memo[_, country] = chunks
+            missing = [_ for _ in missing if _ not in cached]
+        computed = {_: self.split(texts[_], country=country, id_=_) for _ in missing}
+        if self.cache is not None and computed:
+            self.cache.put_many(computed, model="chunks", params=params)
+        return {_: self._memo[_, country] for _ in texts}
@@ -1,18 +1,26 @@
 # %%
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import numpy as np
+import sentence_transformers
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 from pathlib import Path
 import pandas as pd
-from nltk.tokenize import sent_tokenize
-from tqdm import tqdm
-import json
+from food_chapter_cache import TextCache
+from food_chapter_chunking import Chunker, split_text
+from food_chapter_embedding_store import EmbeddingStore
 
 # %%
-## Load the native models (~110M params)
-model_en = SentenceTransformer("bert-base-uncased")
-model_pt = SentenceTransformer("neuralmind/bert-base-portuguese-cased")
-model_pl = SentenceTransformer("dkleczek/bert-base-polish-cased-v1")
-models = {"uk": model_en, "portugal": model_pt, "poland": model_pl}
+## The native models (~110M params), they are loaded on first use so every
+## worker process loads only the model it needs
+MODEL_NAMES = {
+    "uk": "bert-base-uncased",
+    "portugal": "neuralmind/bert-base-portuguese-cased",
+    "poland": "dkleczek/bert-base-polish-cased-v1",
+}
+models = {}
 # %%
 ## Define globals
 ROOT = Path(__file__).parent.parent
@@ -23,35 +31,18 @@ data = pd.read_csv(PROC / "food_texts.csv", index_col=0)
 
 # %%
 ## Define functions
-def split_text(text: str, country: str = "uk", max_length: int = 512) -> list:
-    """
-    Splits the input text into chunks of a specified maximum length.
+def load_model(country: str) -> SentenceTransformer:
+    """Loads the native model of a country once and keeps it in models.
 
     Parameters:
-    text (str): The input text to be split.
-    country (str): The country code to determine the sentence tokenizer to use.
-    max_length (int): The maximum length of each chunk.
+    country (str): The country code.
 
     Returns:
-    list: A list of text chunks.
+    SentenceTransformer: The sentence transformer model of the country.
     """
-    language_map = {"uk": "English", "poland": "Polish", "portugal": "Portuguese"}
-    language = language_map.get(country.lower(), "English")
-    sentences = sent_tokenize(text, language=language)
-    chunks = []
-    current_chunk = []
-
-    for sent in sentences:
-        if len(" ".join(current_chunk + [sent])) <= max_length:
-            current_chunk.append(sent)
-        else:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [sent]
-
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
-
-    return chunks
+    if country not in models:
+        models[country] = SentenceTransformer(MODEL_NAMES[country])
+    return models[country]
 
 
 def encode_text(text: str, country: str, model) -> np.ndarray:
@@ -71,18 +62,191 @@ def encode_text(text: str, country: str, model) -> np.ndarray:
     return doc_vector
 
 
+def encode_chunks(chunks: list, country: str, batch_size: int = 64) -> np.ndarray:
+    """Encodes the chunks of many texts with the model of a country in large batches. The model sorts the chunks by
+    length before batching them, so a batch needs little padding.
+
+    Parameters:
+    chunks (list): The chunks to encode.
+    country (str): The country code of the model.
+    batch_size (int): The number of chunks passed through the model at once.
+
+    Returns:
+    np.ndarray: The embeddings of the chunks, one row per chunk.
+    """
+    model = load_model(country)
+    return model.encode(
+        chunks, batch_size=batch_size, show_progress_bar=True, convert_to_numpy=True
+    )
+
+
+def mean_pool(ids: list, embeddings: np.ndarray) -> dict:
+    """Averages the embeddings of the chunks which belong to the same text. The chunks of a text have to be next to
+    each other.
+
+    Parameters:
+    ids (list): The id of the text of every chunk.
+    embeddings (np.ndarray): The embeddings of the chunks, one row per chunk.
+
+    Returns:
+    dict: A mapping from the text id to its averaged embedding vector.
+    """
+    starts = [i for i in range(len(ids)) if i == 0 or ids[i] != ids[i - 1]]
+    sums = np.add.reduceat(embeddings, starts, axis=0)
+    counts = np.diff(starts + [len(ids)])
+    return {ids[start]: vector for start, vector in zip(starts, sums / counts[:, None])}
+
+
+def encode_corpus(
+    data: pd.DataFrame,
+    batch_size: int = 64,
+    processes: int = 1,
+    chunkers: dict | None = None,
+    cache: TextCache | None = None,
+) -> dict:
+    """Computes the embeddings of all texts at once. The chunks of the whole corpus are grouped by the model of their
+    country, encoded in a few large calls (one per model, optionally each model in its own process), and averaged back
+    per text like in encode_text. With a cache only the texts which were not computed before are encoded.
+
+    Parameters:
+    data (pd.DataFrame): The texts with the body and country columns, indexed by their id.
+    batch_size (int): The number of chunks passed through a model at once.
+    processes (int): The number of models encoding at the same time in separate processes (1 runs them one by one
+    in this process).
+    chunkers (dict): A mapping from the country code to the Chunker of its texts. By default, chunks of 512 characters.
+    cache (TextCache): A cache of the vectors keyed by the text id, the model and the chunking parameters. By default,
+    None.
+
+    Returns:
+    dict: A mapping from the text id to its averaged embedding vector. The texts of other countries are left out.
+    """
+    texts = {country: {} for country in MODEL_NAMES}
+    for _, item in data.iterrows():
+        if item["country"] in texts:
+            texts[item["country"]][_] = item["body"]
+
+    chunkers = {
+        country: (chunkers or {}).get(country) or Chunker(cache=cache)
+        for country in MODEL_NAMES
+    }
+    vectors = {}
+    if cache is not None:
+        for country, bodies in texts.items():
+            vectors.update(
+                cache.get_many(
+                    bodies,
+                    model=MODEL_NAMES[country],
+                    params=chunkers[country].params,
+                )
+            )
+
+    ## Collect the chunks of every text which is not in the cache
+    chunks = {country: ([], []) for country in MODEL_NAMES}
+    for country, bodies in texts.items():
+        ids, inputs = chunks[country]
+        split = chunkers[country].split_many(
+            {_: body for _, body in bodies.items() if _ not in vectors},
+            country=country,
+        )
+        for _, text_chunks in split.items():
+            ids.extend([_] * len(text_chunks))
+            inputs.extend(text_chunks)
+    chunks = {country: pair for country, pair in chunks.items() if pair[0]}
+
+    if processes > 1:
+        ## Spawn the workers, CUDA does not survive a fork
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=get_context("spawn")
+        ) as pool:
+            futures = {
+                country: pool.submit(encode_chunks, inputs, country, batch_size)
+                for country, (_, inputs) in chunks.items()
+            }
+            embeddings = {
+                country: future.result() for country, future in futures.items()
+            }
+    else:
+        embeddings = {
+            country: encode_chunks(inputs, country=country, batch_size=batch_size)
+            for country, (_, inputs) in chunks.items()
+        }
+
+    for country, (ids, _) in chunks.items():
+        computed = mean_pool(ids, embeddings[country])
+        if cache is not None:
+            cache.put_many(
+                computed, model=MODEL_NAMES[country], params=chunkers[country].params
+            )
+        vectors.update(computed)
+    return vectors
+
+
 def main():
-    with open(PROC / "food_texts_embeddings.jsonl", "w") as file:
-        for _, item in tqdm(
-            data.iterrows(), total=data.shape[0], desc="Computing embeddings"
-        ):
-            for model in models:
-                if item["country"] == model:
-                    embeddings = encode_text(
-                        item["body"], country=model, model=models[model]
-                    )
-                    tmp = {"id": _, "embeddings": embeddings.tolist()}
-                    file.write(json.dumps(tmp) + "\n")
+    parser = argparse.ArgumentParser(
+        description="Compute the embeddings of the food texts."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="number of chunks passed through a model at once",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of models encoding at the same time in separate processes",
+    )
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="compute every text again instead of reusing the cached vectors",
+    )
+    parser.add_argument(
+        "--token-chunks",
+        action="store_true",
+        help="count the length of the chunks in the tokens of the model instead of characters",
+    )
+    args = parser.parse_args()
+    cache = TextCache() if args.cache else None
+    chunkers = {
+        country: Chunker(
+            tokenizer=AutoTokenizer.from_pretrained(name)
+            if args.token_chunks
+            else None,
+            cache=cache,
+        )
+        for country, name in MODEL_NAMES.items()
+    }
+    vectors = encode_corpus(
+        data,
+        batch_size=args.batch_size,
+        processes=args.processes,
+        chunkers=chunkers,
+        cache=cache,
+    )
+    if cache is not None:
+        cache.close()
+    ids = list(dict.fromkeys(_ for _ in data.index if _ in vectors))
+    countries = dict(zip(data.index, data["country"]))
+    metadata = {
+        "models": {
+            country: MODEL_NAMES[country]
+            for country in data["country"].unique()
+            if country in MODEL_NAMES
+        },
+        "sentence_transformers": sentence_transformers.__version__,
+    }
+    EmbeddingStore.write(
+        PROC / "food_texts_embeddings",
+        ids=ids,
+        countries=[countries[_] for _ in ids],
+        vectors=vectors,
+        dtype=args.dtype,
+        metadata=metadata,
+    )
 
 
 # %%
@@ -1,12 +1,19 @@
 # %%
+import argparse
+import torch
 from transformers import pipeline
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 import json
-from nltk.tokenize import sent_tokenize
+from food_chapter_cache import TextCache
+from food_chapter_chunking import Chunker, split_text
+from food_chapter_sentiment_table import flatten_sentiment
 
 # %%
+## Use the GPU if there is one
+DEVICE = 0 if torch.cuda.is_available() else -1
+
 ## Load the Pre-trained Multilingual Sentiment Classifier
 sentiment = pipeline(
     "sentiment-analysis",
@@ -14,6 +21,7 @@ sentiment = pipeline(
     top_k=None,
     truncation=True,
     max_length=512,
+    device=DEVICE,
 )
 
 sentiment_pl = pipeline(
@@ -22,7 +30,9 @@ sentiment_pl = pipeline(
     top_k=None,
     truncation=True,
     max_length=512,
+    device=DEVICE,
 )
+pipelines = {"poland": sentiment_pl, "uk": sentiment}
 
 # %%
 ## Define globals
@@ -34,37 +44,6 @@ data = pd.read_csv(PROC / "food_texts.csv", index_col=0)
 
 # %%
 ## Define functions
-def split_text(text: str, country: str = "uk", max_length: int = 512) -> list:
-    """
-    Splits the input text into chunks of a specified maximum length.
-
-    Parameters:
-    text (str): The input text to be split.
-    country (str): The country code to determine the sentence tokenizer to use.
-    max_length (int): The maximum length of each chunk.
-
-    Returns:
-    list: A list of text chunks.
-    """
-    language_map = {"uk": "English", "poland": "Polish", "portugal": "Portuguese"}
-    language = language_map.get(country.lower(), "English")
-    sentences = sent_tokenize(text, language=language)
-    chunks = []
-    current_chunk = []
-
-    for sent in sentences:
-        if len(" ".join(current_chunk + [sent])) <= max_length:
-            current_chunk.append(sent)
-        else:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [sent]
-
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
-
-    return chunks
-
-
 def compute_sentiment(text: str, country: str, sentiment_pipeline) -> list:
     """
     Computes the sentiment for each chunk of text using the specified sentiment analysis pipeline.
@@ -87,21 +66,145 @@ def compute_sentiment(text: str, country: str, sentiment_pipeline) -> list:
     return sentiments
 
 
+def enable_padding(sentiment_pipeline) -> None:
+    """
+    Makes sure the pipeline can pad a batch of chunks. GPT-2 models (e.g. the Polish one) come without a padding token,
+    so the end-of-text token is used instead.
+
+    Parameters:
+    sentiment_pipeline: The sentiment analysis pipeline to use.
+    """
+    tokenizer = sentiment_pipeline.tokenizer
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if sentiment_pipeline.model.config.pad_token_id is None:
+        sentiment_pipeline.model.config.pad_token_id = tokenizer.pad_token_id
+
+
+def compute_sentiment_batched(
+    data: pd.DataFrame,
+    pipelines: dict,
+    batch_size: int = 32,
+    chunkers: dict | None = None,
+    cache: TextCache | None = None,
+) -> dict:
+    """
+    Computes the sentiment for every chunk of every text at once. The chunks of the whole corpus are collected, sorted
+    by their number of tokens (so a batch needs little padding), run through the pipeline in batches, and scattered back
+    to the texts they come from. With a cache only the texts which were not computed before are run.
+
+    Parameters:
+    data (pd.DataFrame): The texts with the body and country columns, indexed by their id.
+    pipelines (dict): A mapping from the country code to the sentiment analysis pipeline, "uk" is used for the rest.
+    batch_size (int): The number of chunks passed through the model at once.
+    chunkers (dict): A mapping from the country code to the Chunker of its texts. By default, chunks of 512 characters.
+    cache (TextCache): A cache of the results keyed by the text id, the model and the chunking parameters. By default,
+    None.
+
+    Returns:
+    dict: A mapping from the text id to a list of sentiment results for each chunk (like compute_sentiment).
+    """
+    ## Group the texts by the pipeline of their country
+    texts = {country: {} for country in pipelines}
+    for _, item in data.iterrows():
+        country = item["country"] if item["country"] in pipelines else "uk"
+        texts[country][_] = item.body
+
+    results = {}
+    for country, sentiment_pipeline in pipelines.items():
+        model = sentiment_pipeline.model.name_or_path
+        chunker = (chunkers or {}).get(country) or Chunker(cache=cache)
+        params = chunker.params
+        if cache is not None:
+            results.update(cache.get_many(texts[country], model=model, params=params))
+        computed = {_: [] for _ in texts[country] if _ not in results}
+        ## Collect the chunks of every text which is not in the cache
+        split = chunker.split_many(
+            {_: texts[country][_] for _ in computed}, country=country
+        )
+        chunks = [(_, chunk) for _ in computed for chunk in split[_] if chunk.strip()]
+        if chunks:
+            enable_padding(sentiment_pipeline)
+            inputs = [chunk for _, chunk in chunks]
+            ## Sort the chunks from the longest to the shortest
+            input_ids = sentiment_pipeline.tokenizer(
+                inputs, truncation=True, max_length=512
+            )["input_ids"]
+            order = sorted(
+                range(len(inputs)), key=lambda i: len(input_ids[i]), reverse=True
+            )
+            ## A generator makes the pipeline yield the results as the batches finish
+            outputs = sentiment_pipeline(
+                (inputs[i] for i in order), batch_size=batch_size
+            )
+            ## Put the results back in the order of the chunks
+            sentiments = [None] * len(inputs)
+            for i, result in zip(order, tqdm(outputs, total=len(inputs), desc=country)):
+                sentiments[i] = result
+            for (_, chunk), result in zip(chunks, sentiments):
+                computed[_].append(result)
+        if cache is not None:
+            cache.put_many(computed, model=model, params=params)
+        results.update(computed)
+    return results
+
+
 # %%
 def main():
+    parser = argparse.ArgumentParser(
+        description="Compute the sentiment of the food texts."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="number of chunks passed through the model at once",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="compute every text again instead of reusing the cached results",
+    )
+    parser.add_argument(
+        "--token-chunks",
+        action="store_true",
+        help="count the length of the chunks in the tokens of the model instead of characters",
+    )
+    args = parser.parse_args()
+    cache = TextCache() if args.cache else None
+    chunkers = {
+        country: Chunker(
+            tokenizer=sentiment_pipeline.tokenizer if args.token_chunks else None,
+            cache=cache,
+        )
+        for country, sentiment_pipeline in pipelines.items()
+    }
+    results = compute_sentiment_batched(
+        data,
+        pipelines=pipelines,
+        batch_size=args.batch_size,
+        chunkers=chunkers,
+        cache=cache,
+    )
+    ## The number of characters of the chunks which were scored, for the length-weighted sentiment
+    lengths = {}
+    for country, chunker in chunkers.items():
+        texts = data[
+            (data["country"] == country)
+            | ((country == "uk") & ~data["country"].isin(list(pipelines)))
+        ]["body"].to_dict()
+        for _, chunks in chunker.split_many(texts, country=country).items():
+            lengths[_] = [len(chunk) for chunk in chunks if chunk.strip()]
+    if cache is not None:
+        cache.close()
     with open(PROC / "food_texts_sentiment.jsonl", "w") as file:
-        for _, item in tqdm(data.iterrows()):
-            if item["country"] == "poland":
-                result = compute_sentiment(
-                    item.body, country="poland", sentiment_pipeline=sentiment_pl
-                )
-            else:
-                result = compute_sentiment(
-                    item.body, country="uk", sentiment_pipeline=sentiment
-                )
-
-            tmp = {"id": _, "sentiment": result}
+        for _ in data.index:
+            tmp = {"id": _, "sentiment": results[_]}
             file.write(json.dumps(tmp) + "\n")
+    ## The same results as a flat table with one row per text, chunk and label
+    table = flatten_sentiment({_: results[_] for _ in data.index}, lengths=lengths)
+    table.to_parquet(PROC / "food_texts_sentiment.parquet", index=False)
 
 
 # %%
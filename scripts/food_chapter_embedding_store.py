@@ -0,0 +1,252 @@
+# %%
+import argparse
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# %%
+## Define globals
+ROOT = Path(__file__).parent.parent
+DATA = ROOT / "data"
+PROC = DATA / "processed"
+## Version of the layout of the store on disk
+FORMAT_VERSION = 1
+
+
+# %%
+## Define classes
+class EmbeddingStore:
+    """
+    Embeddings kept in a binary store: a directory with a float32 (or float16)
+    matrix (vectors.npy), an id index (index.csv with the id and the country of
+    every row) and metadata (meta.json with the models, dtype, dimension and
+    version). The matrix is memory-mapped, so only the rows which are sliced are
+    read from disk. The rows are grouped by country, so the vectors of a country
+    are a zero-copy view of the matrix.
+
+    Example
+    -------
+    store = EmbeddingStore(PROC / "food_texts_embeddings")
+    vectors = store.country("poland")
+    vectors = store.get(df["id"])
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path
+            a path to the store directory.
+        """
+        self.path = Path(path)
+        with open(self.path / "meta.json", "r") as file:
+            self.meta = json.load(file)
+        if self.meta["format"] > FORMAT_VERSION:
+            raise ValueError(f"Unknown format {self.meta['format']} of {self.path}")
+        self.index = pd.read_csv(self.path / "index.csv", dtype={"id": str})
+        self._rows = pd.Series(np.arange(len(self.index)), index=self.index["id"])
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, id_) -> bool:
+        return id_ in self._rows.index
+
+    def __getitem__(self, id_) -> np.ndarray:
+        return self.vectors[self._rows[id_]]
+
+    @property
+    def ids(self) -> list:
+        return self.index["id"].tolist()
+
+    def rows(self, ids) -> np.ndarray:
+        """Returns the row numbers of the given ids in the matrix.
+
+        Parameters
+        ----------
+        ids
+            a list (or series) of ids.
+
+        Returns
+        -------
+            an array with one row number per id.
+        """
+        return self._rows.loc[list(ids)].to_numpy()
+
+    def get(self, ids) -> np.ndarray:
+        """Returns the vectors of the given ids in their order. Only these rows
+        are read from disk.
+
+        Parameters
+        ----------
+        ids
+            a list (or series) of ids.
+
+        Returns
+        -------
+            a matrix with one row per id.
+        """
+        return self.vectors[self.rows(ids)]
+
+    def country(self, country: str) -> np.ndarray:
+        """Returns the vectors of a country as a view of the memory-mapped matrix.
+
+        Parameters
+        ----------
+        country
+            name of the country, e.g. "poland".
+
+        Returns
+        -------
+            a matrix with the rows of the country in the order of ids_of(country).
+        """
+        start, stop = self.meta["countries"][country]
+        return self.vectors[start:stop]
+
+    def ids_of(self, country: str) -> list:
+        """Returns the ids of a country in the order of its rows."""
+        start, stop = self.meta["countries"][country]
+        return self.index["id"].iloc[start:stop].tolist()
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        ids: list,
+        countries: list,
+        vectors,
+        dtype: str = "float32",
+        metadata: dict | None = None,
+    ):
+        """Creates a store and writes the vectors into it row by row.
+
+        Parameters
+        ----------
+        path
+            a path to the store directory.
+        ids
+            a list of ids.
+        countries
+            a list with the country of every id.
+        vectors
+            a mapping (or a function) from an id to its vector.
+        dtype, optional
+            either "float32" or "float16", by default "float32"
+        metadata, optional
+            a mapping with additional metadata, e.g. the names of the models, by default None
+
+        Returns
+        -------
+            the EmbeddingStore.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        get = vectors if callable(vectors) else vectors.__getitem__
+        index = pd.DataFrame({"id": ids, "country": countries})
+        index = index.sort_values("country", kind="stable").reset_index(drop=True)
+        dim = len(get(index["id"].iloc[0])) if len(index) > 0 else 0
+        matrix = np.lib.format.open_memmap(
+            path / "vectors.npy", mode="w+", dtype=dtype, shape=(len(index), dim)
+        )
+        for row, id_ in enumerate(index["id"]):
+            matrix[row] = get(id_)
+        matrix.flush()
+        del matrix
+
+        bounds = {
+            country: [int(rows.min()), int(rows.max()) + 1]
+            for country, rows in index.groupby("country").groups.items()
+        }
+        meta = {
+            "format": FORMAT_VERSION,
+            "dtype": dtype,
+            "dim": dim,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "countries": bounds,
+            **(metadata or {}),
+        }
+        index.to_csv(path / "index.csv", index=False)
+        with open(path / "meta.json", "w") as file:
+            json.dump(meta, file, indent=2)
+        return cls(path)
+
+    @classmethod
+    def from_jsonl(
+        cls,
+        jsonl: str,
+        path: str,
+        countries: dict,
+        dtype: str = "float32",
+        metadata: dict | None = None,
+    ):
+        """Converts a JSON line file with {"id": ..., "embeddings": [...]} per
+        line into a store. Only one line is kept in memory at a time.
+
+        Parameters
+        ----------
+        jsonl
+            a path to the JSON line file.
+        path
+            a path to the store directory.
+        countries
+            a mapping from the id to its country.
+        dtype, optional
+            either "float32" or "float16", by default "float32"
+        metadata, optional
+            a mapping with additional metadata, by default None
+
+        Returns
+        -------
+            the EmbeddingStore.
+        """
+        ## First pass: find the line of every id (the last one wins)
+        offsets = {}
+        with open(jsonl, "rb") as file:
+            offset = file.tell()
+            for line in iter(file.readline, b""):
+                offsets[str(json.loads(line)["id"])] = offset
+                offset = file.tell()
+
+        ## Second pass: read the lines in the order of the rows
+        with open(jsonl, "rb") as file:
+
+            def vector(id_):
+                file.seek(offsets[id_])
+                return json.loads(file.readline())["embeddings"]
+
+            ids = [id_ for id_ in offsets if id_ in countries]
+            return cls.write(
+                path,
+                ids=ids,
+                countries=[countries[id_] for id_ in ids],
+                vectors=vector,
+                dtype=dtype,
+                metadata=metadata,
+            )
+
+
+# %%
+## Define functions
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert food_texts_embeddings.jsonl into an embedding store."
+    )
+    parser.add_argument("--jsonl", default=PROC / "food_texts_embeddings.jsonl")
+    parser.add_argument("--output", default=PROC / "food_texts_embeddings")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+    data = pd.read_csv(PROC / "food_texts.csv", index_col=None, dtype={"id": str})
+    countries = dict(zip(data["id"], data["country"]))
+    store = EmbeddingStore.from_jsonl(
+        args.jsonl, args.output, countries=countries, dtype=args.dtype
+    )
+    print(f"{len(store)} vectors written to {store.path}")
+
+
+# %%
+if __name__ == "__main__":
+    main()
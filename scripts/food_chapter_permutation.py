@@ -0,0 +1,219 @@
+# %%
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+# %%
+## Define globals
+## Largest number of values in one block of permutations (~32 MB per float64 array)
+BLOCK_ELEMENTS = 2**22
+
+
+# %%
+## Define classes
+@dataclass
+class PermutationResult:
+    """
+    The result of a permutation test of two groups.
+    """
+
+    label_a: str
+    label_b: str
+    statistic: str
+    observed: float
+    pvalue: float
+    n_permutations: int
+    alpha: float
+
+    @property
+    def significant(self) -> bool:
+        return self.pvalue < self.alpha
+
+    def __str__(self) -> str:
+        status = "SIGNIFICANT" if self.significant else "NOT SIGNIFICANT"
+        return (
+            f"{self.label_a} vs {self.label_b} (Permutation):\n"
+            f"  Observed {self.statistic}: {self.observed}\n"
+            f"  p-value:            {self.pvalue} ({status})"
+        )
+
+
+# %%
+## Define functions
+def batched_median(values: np.ndarray, axis: int = -1, keepdims: bool = False):
+    """Computes the medians along an axis with np.partition, which only moves the
+    middle values in place instead of sorting every row.
+
+    Parameters
+    ----------
+    values
+        an array, e.g. one permutation per row.
+    axis, optional
+        the axis along which the medians are computed, by default -1
+    keepdims, optional
+        True if the axis is kept with length one, by default False
+
+    Returns
+    -------
+        the medians.
+    """
+    n = values.shape[axis]
+    if n % 2 == 1:
+        middle = np.partition(values, n // 2, axis=axis)
+        median = np.take(middle, [n // 2], axis=axis)
+    else:
+        middle = np.partition(values, [n // 2 - 1, n // 2], axis=axis)
+        median = np.take(middle, [n // 2 - 1, n // 2], axis=axis).mean(
+            axis=axis, keepdims=True
+        )
+    return median if keepdims else np.squeeze(median, axis=axis)
+
+
+def median_difference(group_a: np.ndarray, group_b: np.ndarray) -> np.ndarray:
+    """Computes |Mdn_A - Mdn_B| along the last axis.
+
+    Parameters
+    ----------
+    group_a
+        values of the first group, shape (..., n_a).
+    group_b
+        values of the second group, shape (..., n_b).
+
+    Returns
+    -------
+        the statistic of every row.
+    """
+    return np.abs(batched_median(group_a) - batched_median(group_b))
+
+
+def spread_difference(group_a: np.ndarray, group_b: np.ndarray) -> np.ndarray:
+    """Computes the absolute difference of the mean absolute deviations from the
+    median of two groups along the last axis, so one call handles a whole block
+    of permutations (one permutation per row).
+
+    Parameters
+    ----------
+    group_a
+        values of the first group, shape (..., n_a).
+    group_b
+        values of the second group, shape (..., n_b).
+
+    Returns
+    -------
+        the statistic of every row.
+    """
+    dev_a = np.abs(group_a - batched_median(group_a, keepdims=True))
+    dev_b = np.abs(group_b - batched_median(group_b, keepdims=True))
+    return np.abs(np.mean(dev_a, axis=-1) - np.mean(dev_b, axis=-1))
+
+
+def count_extreme(
+    combined: np.ndarray,
+    n_a: int,
+    statistic,
+    observed: float,
+    size: int,
+    rng: np.random.Generator,
+) -> tuple:
+    """Runs one block of permutations and counts the statistics which are at
+    least as large and at most as large as the observed one.
+
+    Parameters
+    ----------
+    combined
+        values of both groups, the first n_a belong to the first group.
+    n_a
+        size of the first group.
+    statistic
+        a function which takes two arrays and computes the statistic along the last axis.
+    observed
+        the statistic of the original groups.
+    size
+        number of permutations in the block.
+    rng
+        a random generator of the block.
+
+    Returns
+    -------
+        a tuple with the numbers of permutations with a statistic >= observed
+        and <= observed.
+    """
+    ## Every row is an independent permutation of the indices
+    index = np.argsort(rng.random((size, len(combined))), axis=1)
+    shuffled = combined[index]
+    stats = statistic(shuffled[:, :n_a], shuffled[:, n_a:])
+    return int(np.sum(stats >= observed)), int(np.sum(stats <= observed))
+
+
+def permutation_test(
+    group_a,
+    group_b,
+    statistic=spread_difference,
+    n_permutations: int = 10000,
+    rng=None,
+    processes: int = 1,
+    block_size: int | None = None,
+    alternative: str = "greater",
+) -> tuple:
+    """Runs a two-sample permutation test in blocks of permutations which fit in
+    memory. Every block has its own random stream spawned from rng, so the
+    result is reproducible and does not depend on the number of processes.
+
+    Parameters
+    ----------
+    group_a
+        values of the first group.
+    group_b
+        values of the second group.
+    statistic, optional
+        a function which takes two arrays and computes the statistic along the
+        last axis (it has to be defined at module level to run in processes), by
+        default spread_difference
+    n_permutations, optional
+        number of permutations, by default 10000
+    rng, optional
+        a random generator or a seed, by default None (a fresh generator)
+    processes, optional
+        number of processes the blocks are spread over, by default 1
+    block_size, optional
+        number of permutations in a block, by default as many as fit in BLOCK_ELEMENTS
+    alternative, optional
+        "greater" for the proportion of permutations with a statistic as large or
+        larger than the observed one, or "two-sided" for the p-value of
+        scipy.stats.permutation_test with its default alternative, by default "greater"
+
+    Returns
+    -------
+        a tuple (observed, p-value).
+    """
+    rng = np.random.default_rng(rng)
+    group_a = np.asarray(group_a, dtype=float)
+    group_b = np.asarray(group_b, dtype=float)
+    combined = np.concatenate([group_a, group_b])
+    observed = float(statistic(group_a, group_b))
+    if block_size is None:
+        block_size = max(1, BLOCK_ELEMENTS // max(len(combined), 1))
+    sizes = [
+        min(block_size, n_permutations - start)
+        for start in range(0, n_permutations, block_size)
+    ]
+    rngs = rng.spawn(len(sizes))
+    args = [
+        (combined, len(group_a), statistic, observed, size, block_rng)
+        for size, block_rng in zip(sizes, rngs)
+    ]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            counts = list(pool.map(count_extreme, *zip(*args)))
+    else:
+        counts = [count_extreme(*arg) for arg in args]
+    greater = sum(count for count, _ in counts)
+    less = sum(count for _, count in counts)
+    if alternative == "greater":
+        return observed, greater / n_permutations
+    elif alternative == "two-sided":
+        ## The randomized p-values of SciPy count the observed statistic as well
+        pvalue = 2 * min(greater + 1, less + 1) / (n_permutations + 1)
+        return observed, min(pvalue, 1.0)
+    raise ValueError(f"Unknown alternative {alternative}")
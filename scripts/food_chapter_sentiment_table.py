@@ -0,0 +1,146 @@
+# %%
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# %%
+## Define globals
+ROOT = Path(__file__).parent.parent
+DATA = ROOT / "data"
+PROC = DATA / "processed"
+
+map_sentiment = {"positive": 1, "negative": -1}
+
+
+# %%
+## Define functions
+def flatten_sentiment(results: dict, lengths: dict | None = None) -> pd.DataFrame:
+    """Turns the sentiment of the chunks into a flat table with one row per
+    text, chunk and label.
+
+    Parameters
+    ----------
+    results
+        a mapping from the text id to a list with the scores of all labels of
+        every chunk (like compute_sentiment_batched returns).
+    lengths, optional
+        a mapping from the text id to the number of characters of every chunk,
+        by default None
+
+    Returns
+    -------
+        a data frame with id, chunk_idx, label, score and length columns.
+    """
+    rows = [
+        (str(_), chunk_idx, item["label"], item["score"])
+        for _, chunks in results.items()
+        for chunk_idx, chunk in enumerate(chunks)
+        for item in chunk
+    ]
+    table = pd.DataFrame(rows, columns=["id", "chunk_idx", "label", "score"])
+    if lengths is not None:
+        keys = pd.MultiIndex.from_tuples(
+            [
+                (str(_), chunk_idx, length)
+                for _, chunk_lengths in lengths.items()
+                for chunk_idx, length in enumerate(chunk_lengths)
+            ],
+            names=["id", "chunk_idx", "length"],
+        ).to_frame(index=False)
+        table = table.merge(keys, on=["id", "chunk_idx"], how="left")
+    else:
+        table["length"] = np.nan
+    return table
+
+
+def load_chunks(path: str = PROC / "food_texts_sentiment.parquet") -> pd.DataFrame:
+    """Loads the chunk-level sentiment table. A JSON line file written by the
+    older versions of food_chapter_compute_sentiment.py is flattened on the fly.
+
+    Parameters
+    ----------
+    path, optional
+        a path to the Parquet file (or the JSON line file), by default
+        PROC / "food_texts_sentiment.parquet"
+
+    Returns
+    -------
+        a data frame with id, chunk_idx, label, score and length columns.
+    """
+    path = Path(path)
+    if path.suffix == ".jsonl":
+        results = {}
+        with open(path, "r") as file:
+            for line in file:
+                tmp = json.loads(line)
+                results[tmp["id"]] = tmp["sentiment"]
+        return flatten_sentiment(results)
+    return pd.read_parquet(path)
+
+
+def top_labels(chunks: pd.DataFrame) -> pd.DataFrame:
+    """Keeps the most likely label of every chunk and turns it into a signed
+    value (positive 1, negative -1, neutral 0) weighted by its score.
+
+    Parameters
+    ----------
+    chunks
+        a data frame from load_chunks.
+
+    Returns
+    -------
+        a data frame with one row per chunk and an additional value column.
+    """
+    ## A stable sort keeps the first label among equal scores, like max()
+    top = chunks.sort_values(
+        ["id", "chunk_idx", "score"], ascending=[True, True, False], kind="stable"
+    ).drop_duplicates(["id", "chunk_idx"], keep="first")
+    sign = top["label"].str.lower().map(map_sentiment).fillna(0)
+    return top.assign(value=sign * top["score"])
+
+
+def argmax_mean(top: pd.DataFrame) -> pd.Series:
+    """The mean of the values of the chunks."""
+    return top.groupby("id")["value"].mean()
+
+
+def length_weighted(top: pd.DataFrame) -> pd.Series:
+    """The mean of the values of the chunks weighted by their length."""
+    weighted = top.assign(weighted=top["value"] * top["length"])
+    sums = weighted.groupby("id")[["weighted", "length"]].sum()
+    return sums["weighted"] / sums["length"]
+
+
+def median(top: pd.DataFrame) -> pd.Series:
+    """The median of the values of the chunks."""
+    return top.groupby("id")["value"].median()
+
+
+REDUCERS = {
+    "argmax_mean": argmax_mean,
+    "length_weighted": length_weighted,
+    "median": median,
+}
+
+
+def aggregate(chunks: pd.DataFrame, reducer="argmax_mean") -> pd.DataFrame:
+    """Aggregates the chunk-level sentiment into one value per text.
+
+    Parameters
+    ----------
+    chunks
+        a data frame from load_chunks.
+    reducer, optional
+        a name from REDUCERS or a function which takes the output of top_labels
+        and returns a series indexed by the text id, by default "argmax_mean"
+        (the sentiment used so far)
+
+    Returns
+    -------
+        a data frame with id and sentiment columns.
+    """
+    reducer = REDUCERS[reducer] if isinstance(reducer, str) else reducer
+    sentiment = reducer(top_labels(chunks))
+    return sentiment.rename("sentiment").rename_axis("id").reset_index()
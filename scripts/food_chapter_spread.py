@@ -0,0 +1,121 @@
+# %%
+import numpy as np
+import pandas as pd
+
+from food_chapter_embedding_store import EmbeddingStore
+
+# %%
+## Define globals
+## Number of vectors read from the memory-mapped matrix at once
+BLOCK_ROWS = 50_000
+
+
+# %%
+## Define functions
+def assign_categories(df: pd.DataFrame, categories: dict) -> pd.DataFrame:
+    """Lists every text once for each category it belongs to, so the categories
+    can be used as a grouping key.
+
+    Parameters
+    ----------
+    df
+        a data frame with the texts.
+    categories
+        a mapping from the name of a category to a query which selects its texts,
+        e.g. {"motivation": "mot_refl > 0 | mot_auto > 0"}.
+
+    Returns
+    -------
+        a data frame in a long format with an additional category column.
+    """
+    return pd.concat(
+        [df.query(query).assign(category=name) for name, query in categories.items()],
+        ignore_index=True,
+    )
+
+
+def _blocks(rows: np.ndarray, block_size: int):
+    ## Read the rows in the order they are stored, so the reads are sequential
+    order = np.argsort(rows, kind="stable")
+    for start in range(0, len(order), block_size):
+        yield order[start : start + block_size]
+
+
+def group_centroids(
+    store: EmbeddingStore,
+    rows: np.ndarray,
+    codes: np.ndarray,
+    n_groups: int,
+    block_size: int = BLOCK_ROWS,
+) -> np.ndarray:
+    """Computes the centroid of every group in one pass over the matrix with
+    running sums.
+
+    Parameters
+    ----------
+    store
+        an embedding store with the vectors of the texts.
+    rows
+        the row of every text in the matrix.
+    codes
+        the group of every text (0 to n_groups - 1).
+    n_groups
+        number of groups.
+    block_size, optional
+        number of vectors read at once, by default BLOCK_ROWS
+
+    Returns
+    -------
+        a matrix with one centroid per group.
+    """
+    sums = np.zeros((n_groups, store.vectors.shape[1]))
+    counts = np.bincount(codes, minlength=n_groups)
+    for block in _blocks(rows, block_size):
+        vectors = store.vectors[rows[block]].astype(np.float64)
+        ## Sum the vectors of every group with one matrix product
+        onehot = np.zeros((n_groups, len(block)))
+        onehot[codes[block], np.arange(len(block))] = 1.0
+        sums += onehot @ vectors
+    return sums / np.maximum(counts, 1)[:, None]
+
+
+def cosine_spread(
+    store: EmbeddingStore,
+    df: pd.DataFrame,
+    by="country",
+    block_size: int = BLOCK_ROWS,
+) -> pd.Series:
+    """Computes the cosine distance of every text to the centroid of its group
+    (like cdist(vectors, centroid, metric="cosine") per group). The matrix is
+    read block by block twice: once for the centroids and once for the distances,
+    so only one block is in memory as float64.
+
+    Parameters
+    ----------
+    store
+        an embedding store with the vectors of the texts.
+    df
+        a data frame with an id column and the grouping columns.
+    by, optional
+        a column or a list of columns to group by, e.g. ["country", "category"]
+        (compare assign_categories), by default "country"
+    block_size, optional
+        number of vectors read at once, by default BLOCK_ROWS
+
+    Returns
+    -------
+        the distances aligned with the index of df.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    codes, groups = pd.MultiIndex.from_frame(df[by]).factorize()
+    rows = store.rows(df["id"])
+    centroids = group_centroids(store, rows, codes, len(groups), block_size=block_size)
+    norms = np.linalg.norm(centroids, axis=1)
+
+    distances = np.empty(len(df))
+    for block in _blocks(rows, block_size):
+        vectors = store.vectors[rows[block]].astype(np.float64)
+        dots = np.einsum("ij,ij->i", vectors, centroids[codes[block]])
+        lengths = np.linalg.norm(vectors, axis=1) * norms[codes[block]]
+        distances[block] = 1.0 - dots / lengths
+    return pd.Series(distances, index=df.index, name="distances")
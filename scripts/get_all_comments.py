@@ -1,9 +1,17 @@
 import praw
 import os
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
 from tqdm import tqdm
 import nltk
+from rate_limit import RateLimiter, RateLimitedRequestor
+from checkpoint import Checkpoint, commit_output, open_output
+from author_cache import AuthorCache
+from writers import month_partition, read_table
 
 ## Download lexicons etc.
 nltk.download("punkt")
@@ -28,6 +36,12 @@ password = os.getenv("Reddit_password")
 user_agent = os.getenv("Reddit_User_Agent")
 username = os.getenv("Reddit_Username")
 
+## Reddit allows 100 requests per minute for OAuth clients
+rate_limiter = RateLimiter(rate=100 / 60, burst=5)
+## Every author profile is fetched once and reused for all their comments
+author_cache = AuthorCache()
+DATE_FORMAT = "%d-%m-%Y %H:%M:%S"
+
 
 def convert_date(date_float: float) -> str:
     """
@@ -41,25 +55,49 @@ def convert_date(date_float: float) -> str:
     --------
         (str) : a string representing a date in human-readable format.
     """
-    return datetime.fromtimestamp(date_float).strftime("%d-%m-%Y %H:%M:%S")
+    return datetime.fromtimestamp(date_float).strftime(DATE_FORMAT)
+
+
+def connect() -> praw.Reddit:
+    """
+    Opens a new session with Reddit API. All the sessions share one rate limiter.
+
+    Returns:
+    --------
+        (praw.Reddit) : an instance of Reddit API.
+    """
+    return praw.Reddit(
+        client_id=client_id,
+        client_secret=client_secret,
+        password=password,
+        user_agent=user_agent,
+        username=username,
+        check_for_async=False,
+        requestor_class=RateLimitedRequestor,
+        requestor_kwargs={"rate_limiter": rate_limiter},
+    )
 
 
 ## Connect to Reddit API
-reddit = praw.Reddit(
-    client_id=client_id,
-    client_secret=client_secret,
-    password=password,
-    user_agent=user_agent,
-    username=username,
-    check_for_async=False,
-)
-
-## Get all submissions from Reddit about multilingualparenting
-subreddit = reddit.subreddit("multilingualparenting").top(time_filter="all", limit=None)
-
-## Create a list of dictionaries with the submissions
-submissions = [
-    {
+reddit = connect()
+## Every worker thread gets its own session
+local = threading.local()
+
+
+def submission_to_dict(line, sentiment: bool = True) -> dict:
+    """
+    Takes a submission and converts it into a dictionary with its sentiment.
+
+    Parameters:
+    -----------
+        line (praw.models.Submission): a submission from Reddit.
+        sentiment (bool): if False, the sentiment is left to score_sentiment.py.
+
+    Returns:
+    --------
+        (dict) : a mapping with the most important information about the submission.
+    """
+    submission = {
         "title": line.title,
         "id": line.id,
         "upvote_ratio": line.upvote_ratio,
@@ -70,53 +108,338 @@ submissions = [
         "is_self": line.is_self,
         "created": convert_date(line.created_utc),
     }
-    for line in subreddit
-]
-
-## Create a json lines file with additional key - sentiment
-with open("submissions.jl", "w") as file:
-    for submission in submissions:
-        sentiment = vader.polarity_scores(submission["selftext"])
-        adjusted_compound = sentiment["compound"] * (1 - sentiment["neu"])
+    if sentiment:
+        scores = vader.polarity_scores(submission["selftext"])
+        adjusted_compound = scores["compound"] * (1 - scores["neu"])
         submission["sentiment"] = adjusted_compound
-        file.write(json.dumps(submission) + "\n")
-
-with open("comments.jl", "w") as file:
-    # Iterate over all the submissions
-    for submission in submissions:
-        submission_id = submission["id"]
-
-        # Fetch the submission using its ID
-        submission = reddit.submission(submission_id)
-
-        # Set the option to get all the comments
-        submission.comments.replace_more(limit=None)
-
-        # Iterate over all the comments
-        for comment in tqdm(submission.comments.list()):
-            temp_dict = {}
-            temp_dict["body"] = comment.body
-
-            if temp_dict["body"] == "[deleted]":
-                continue
-
-            temp_dict["score"] = comment.score
-            temp_dict["link"] = comment.permalink
-
-            try:
-                temp_dict["author"] = {
-                    "name": comment.author.name,
-                    "karma": comment.author.comment_karma,
-                    "created_utc": convert_date(comment.author.created_utc),
-                    "has_verified_email": comment.author.has_verified_email,
-                    "is_gold": comment.author.is_gold,
-                }
-            except:  # noqa
-                pass
-
-            temp_dict["created_utc"] = convert_date(comment.created_utc)
-            temp_dict["edited"] = comment.edited
-            temp_dict["is_submitter"] = comment.is_submitter
-            temp_dict["submission_id"] = comment.submission.id
-
-            file.write(json.dumps(temp_dict) + "\n")
+    return submission
+
+
+def get_comments(submission_id: str, since: float = 0.0, client=None) -> tuple:
+    """
+    Downloads all the comments from a given submission.
+
+    Parameters:
+    -----------
+        submission_id (str): a string with a submission id.
+        since (float): only the comments created after this date (in epoch time format) are returned.
+        client (praw.Reddit): a session with Reddit API. By default, the global one.
+
+    Returns:
+    --------
+        (tuple) : a list of mappings, one for each comment that was not deleted, and the creation date of
+        the newest comment in epoch time format.
+    """
+    # Fetch the submission using its ID
+    client = client or reddit
+    submission = client.submission(submission_id)
+
+    # Set the option to get all the comments
+    submission.comments.replace_more(limit=None)
+
+    # Iterate over all the comments
+    comments = []
+    newest = since
+    for comment in submission.comments.list():
+        if comment.created_utc <= since:
+            continue
+        newest = max(newest, comment.created_utc)
+        temp_dict = {}
+        temp_dict["body"] = comment.body
+
+        if temp_dict["body"] == "[deleted]":
+            continue
+
+        temp_dict["score"] = comment.score
+        temp_dict["link"] = comment.permalink
+
+        profile = author_cache.get(comment.author)
+        if profile is not None:
+            temp_dict["author"] = {
+                **profile,
+                "created_utc": convert_date(profile["created_utc"]),
+            }
+
+        temp_dict["created_utc"] = convert_date(comment.created_utc)
+        temp_dict["edited"] = comment.edited
+        temp_dict["is_submitter"] = comment.is_submitter
+        temp_dict["submission_id"] = comment.submission.id
+        comments.append(temp_dict)
+    return comments, newest
+
+
+def get_comments_in_worker(submission_id: str, since: float = 0.0) -> tuple:
+    """
+    Runs get_comments with the session of the current worker thread.
+    """
+    if not hasattr(local, "reddit"):
+        local.reddit = connect()
+    return get_comments(submission_id, since=since, client=local.reddit)
+
+
+def expand_submissions(jobs: list, workers: int = 1):
+    """
+    Downloads the comments of many submissions at once. The results are yielded in the order of
+    the jobs, so the output stays ordered by submission, and at most 2 * workers of them are kept
+    in memory.
+
+    Parameters:
+    -----------
+        jobs (list): a list of tuples (submission_id, since), compare get_comments.
+        workers (int): number of threads, each with its own session with Reddit API.
+
+    Yields:
+    -------
+        (tuple) : the submission id, the list of comments, and the creation date of the newest comment.
+    """
+    if workers <= 1:
+        for submission_id, since in jobs:
+            yield (submission_id, *get_comments(submission_id, since=since))
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        queue = deque()
+        for submission_id, since in jobs:
+            future = executor.submit(get_comments_in_worker, submission_id, since)
+            queue.append((submission_id, future))
+            if len(queue) >= 2 * workers:
+                submission_id, future = queue.popleft()
+                yield (submission_id, *future.result())
+        while queue:
+            submission_id, future = queue.popleft()
+            yield (submission_id, *future.result())
+
+
+def writer_options(subreddit_name: str, format: str, date_key: str) -> dict:
+    """
+    Returns the options of the writer, so a Parquet output is partitioned by subreddit and month.
+
+    Parameters:
+    -----------
+        subreddit_name (str): name of the subreddit.
+        format (str): either "jsonl" or "parquet".
+        date_key (str): the field with the creation date.
+
+    Returns:
+    --------
+        (dict) : keyword arguments passed to open_output.
+    """
+    if format == "jsonl":
+        return {"format": format}
+    partition_by = month_partition(
+        subreddit=subreddit_name, date_key=date_key, date_format=DATE_FORMAT
+    )
+    return {"format": format, "partition_by": partition_by}
+
+
+def read_submissions(format: str) -> list:
+    """
+    Reads back the submissions written out by a previous run.
+
+    Parameters:
+    -----------
+        format (str): either "jsonl" or "parquet".
+
+    Returns:
+    --------
+        (list) : a list of mappings with (at least) the id and num_comments of the submissions.
+    """
+    if format == "parquet":
+        columns = ["id", "num_comments"]
+        return read_table("submissions", columns=columns).to_dict("records")
+    with open("submissions.jl", "r") as file:
+        return [json.loads(line) for line in file]
+
+
+def sync(
+    subreddit_name: str,
+    checkpoint: Checkpoint,
+    workers: int = 1,
+    format="jsonl",
+    sentiment: bool = True,
+) -> None:
+    """
+    Appends only what is new since the last run. It stops walking the newest submissions at the
+    high-water mark (the newest submission seen before), checks the number of comments of the known
+    submissions in batches of 100, and expands only the new submissions and the ones whose number
+    of comments changed. Of the latter it writes out only the comments newer than the ones seen before.
+
+    Parameters:
+    -----------
+        subreddit_name (str): name of the subreddit.
+        checkpoint (Checkpoint): a checkpoint store with the high-water marks.
+        workers (int): number of submissions expanded at once.
+        format (str): either "jsonl" or "parquet".
+        sentiment (bool): if False, the sentiment is left to score_sentiment.py.
+    """
+    kind = f"sync:{subreddit_name}"
+    state = checkpoint.done(kind)
+    high_water = checkpoint.get(kind, 0.0)
+
+    ## Get the submissions posted after the high-water mark
+    new = []
+    for line in reddit.subreddit(subreddit_name).new(limit=None):
+        if line.created_utc <= high_water:
+            break
+        if line.id not in state:
+            new.append(line)
+    new.reverse()
+
+    ## Get the known submissions whose number of comments changed
+    fullnames = [f"t3_{submission_id}" for submission_id in state]
+    changed = [
+        line
+        for line in reddit.info(fullnames=fullnames)
+        if line.num_comments != state[line.id]["num_comments"]
+    ]
+    print(f"{len(new)} new and {len(changed)} changed submissions.")
+
+    lines = {line.id: line for line in new + changed}
+    jobs = [
+        (submission_id, state.get(submission_id, {}).get("newest_comment_utc", 0.0))
+        for submission_id in lines
+    ]
+    ## The cursors are passed through, so --resume still finds the list of
+    ## submissions complete after a sync
+    submissions, submissions_cursor = open_output(
+        "submissions.jl",
+        checkpoint=checkpoint,
+        resume=True,
+        **writer_options(subreddit_name, format=format, date_key="created"),
+    )
+    file, cursor = open_output(
+        "comments.jl",
+        checkpoint=checkpoint,
+        resume=True,
+        **writer_options(subreddit_name, format=format, date_key="created_utc"),
+    )
+    with submissions, file:
+        for submission_id, comments, newest in tqdm(
+            expand_submissions(jobs, workers=workers), total=len(jobs)
+        ):
+            line = lines[submission_id]
+            if line.id not in state:
+                submissions.write(submission_to_dict(line, sentiment=sentiment))
+                commit_output(
+                    file=submissions, checkpoint=checkpoint, cursor=submissions_cursor
+                )
+            for temp_dict in comments:
+                file.write(temp_dict)
+            value = {"num_comments": line.num_comments, "newest_comment_utc": newest}
+            commit_output(
+                file=file,
+                checkpoint=checkpoint,
+                cursor=cursor,
+                done=[(kind, line.id, value)],
+            )
+    if new:
+        checkpoint.set(kind, max(high_water, new[-1].created_utc))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect all submissions and comments from a subreddit."
+    )
+    parser.add_argument("--subreddit", default="multilingualparenting")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the submissions whose comments were already written out",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="append only the submissions and comments which are new since the last run",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of submissions expanded at once"
+    )
+    parser.add_argument("--checkpoint", default="get_all_comments.checkpoint")
+    parser.add_argument("--author-cache", default="authors.json")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument(
+        "--no-sentiment",
+        dest="sentiment",
+        action="store_false",
+        help="skip the sentiment and score the files later with score_sentiment.py",
+    )
+    args = parser.parse_args()
+    checkpoint = Checkpoint(args.checkpoint)
+    if os.path.exists(args.author_cache):
+        author_cache.load(args.author_cache)
+    kind_sync = f"sync:{args.subreddit}"
+
+    if args.sync:
+        sync(
+            subreddit_name=args.subreddit,
+            checkpoint=checkpoint,
+            workers=args.workers,
+            format=args.format,
+            sentiment=args.sentiment,
+        )
+        checkpoint.close()
+        author_cache.save(args.author_cache)
+        return
+
+    ## Reuse the list of submissions if it was completely written out before
+    name = "submissions.jl" if args.format == "jsonl" else "submissions"
+    state = checkpoint.get(name, {})
+    if args.resume and state.get("cursor") == "complete":
+        submissions = read_submissions(format=args.format)
+    else:
+        ## Get all submissions from Reddit
+        subreddit = reddit.subreddit(args.subreddit).top(time_filter="all", limit=None)
+        ## Create a json lines file with additional key - sentiment
+        submissions = []
+        high_water = 0.0
+        file, _ = open_output(
+            "submissions.jl",
+            checkpoint=checkpoint,
+            **writer_options(args.subreddit, format=args.format, date_key="created"),
+        )
+        with file:
+            for line in subreddit:
+                submission = submission_to_dict(line, sentiment=args.sentiment)
+                submissions.append(submission)
+                high_water = max(high_water, line.created_utc)
+                file.write(submission)
+            commit_output(file=file, checkpoint=checkpoint, cursor="complete")
+        ## Set the high-water mark so the next runs can use --sync
+        checkpoint.set(kind_sync, high_water)
+
+    file, _ = open_output(
+        "comments.jl",
+        checkpoint=checkpoint,
+        resume=args.resume,
+        **writer_options(args.subreddit, format=args.format, date_key="created_utc"),
+    )
+    kind = f"{file.name}:submission"
+    finished = checkpoint.done(kind)
+    num_comments = {
+        submission["id"]: submission["num_comments"]
+        for submission in submissions
+        if submission["id"] not in finished
+    }
+    jobs = [(submission_id, 0.0) for submission_id in num_comments]
+    with file:
+        # Iterate over all the submissions
+        for submission_id, comments, newest in tqdm(
+            expand_submissions(jobs, workers=args.workers), total=len(jobs)
+        ):
+            for temp_dict in comments:
+                file.write(temp_dict)
+            ## Record the comments and the finished submission together
+            value = {
+                "num_comments": num_comments[submission_id],
+                "newest_comment_utc": newest,
+            }
+            commit_output(
+                file=file,
+                checkpoint=checkpoint,
+                done=[(kind, submission_id, None), (kind_sync, submission_id, value)],
+            )
+    checkpoint.close()
+    author_cache.save(args.author_cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,40 @@
 ## Load modules
-import requests as rq
+import aiohttp
+import asyncio
+import argparse
+import functools
 import json
 import time
-import sys
 import tqdm
 import nltk
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from rate_limit import RETRY_STATUS_CODES, RateLimiter
+from checkpoint import Checkpoint, commit_output, open_output
+from writers import make_writer
 
 nltk.download("vader_lexicon")
 vader = SentimentIntensityAnalyzer()
+rate_limiter = RateLimiter(rate=1.0)
+
+## Define globals
+COMMENTS_URL = "https://api.pushshift.io/reddit/search/comment/"
+SUBMISSIONS_URL = "https://api.pushshift.io/reddit/search/submission/"
+START_DATE = "2005-06-23 00:00:00"
 
 ## Define custom functions which will make our life easier
 
 
+class PushshiftError(RuntimeError):
+    """
+    The Pushshift API returned an error page (a status which is not retried, or a retried one after the last attempt).
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"Something went wrong. The status code error was {status}.")
+        self.status = status
+        self.message = message
+
+
 def parse_date(date, format="human"):
     """ "
     It takes a string and converts it into either human readable date format or epoch date format
@@ -32,154 +54,356 @@ def parse_date(date, format="human"):
         return time.strftime(pattern, time.localtime(int(date)))
 
 
-def collect_data(source_url, payload):
+def process_comment(line, sentiment=True):
     """
-    It takes the Pushift endpoint and payload as arguments and sends a request to the given URL. Depending on the status code it either returns
-    the list of mappings, a status code, or sleeps for 60 seconds and tries again to scrape the data.
+    It computes the sentiment of the comment body and converts its creation date into human readable format.
 
     Parameters:
     ===========
-    source_url: str
-        A string with url of the Pushshift endpoint.
-    payload:
-        A mapping with parameters passed to the Pushshift API.
+    line: dict
+        A mapping with a comment returned by the Pushshift API.
+    sentiment: bool
+        If False, the sentiment is left to score_sentiment.py.
     """
-    if "after" not in payload:
-        payload["after"] = parse_date("2005-06-23 00:00:00")
-    response = rq.get(source_url, params=payload)
-    if response.status_code == 200:
-        return json.loads(response.text)["data"]
-    elif (
-        response.status_code == 429
-        or response.status_code == 523
-        or response.status_code == 502
-    ):
-        for i in range(60, 0, -1):
-            sys.stdout.write(f"The compulasatory break finishes in {str(i)} seconds\r")
-            sys.stdout.flush()
-            time.sleep(1)
-        sys.stdout.write(100 * " " + "\r")
-        return collect_data(source_url=source_url, payload=payload)
-    else:
-        return [{"status": response.status_code, "message": response.content}]
-
-
-## Define the parameters and options
-source_url = "https://api.pushshift.io/reddit/search/comment/"
-payload = {"subreddit": "urbanplanning", "size": 100}
-
-## Collect first batch of data
-data_comments = collect_data(source_url=source_url, payload=payload)
-
-## Open a file in write mode
-with open("comments.jl", "w") as file:
-    ## Write out the data you already collected
-    for line in data_comments:
+    if sentiment:
         temp = vader.polarity_scores(line["body"])
         line["pos"] = temp["pos"]
         line["neg"] = temp["neg"]
         line["neu"] = temp["neu"]
         line["compound"] = temp["compound"]
-        line["created_utc"] = parse_date(line["created_utc"], format="epoch")
-        file.write(json.dumps(line) + "\n")
-    ## Set the prpogress bar
-    pbar = tqdm.tqdm(position=0, leave=True, initial=100)
-    ## Create a while-loop
-    while len(data_comments) > 0:
-        ## Check if we got data from Reddit or a strange status code
-        if len(data_comments[0].keys()) > 2:
-            ## Get the last collected data date in epoch time
-            after = parse_date(data_comments[-1]["created_utc"])
-            ## Update the payload after field
-            payload["after"] = after
-            ## Collect the data
-            data_comments = collect_data(source_url=source_url, payload=payload)
-            ## Write out the collected data to the file
-            for line in data_comments:
-                if "created_utc" in line:
-                    ## Compute sentiment of the text
-                    temp = vader.polarity_scores(line["body"])
-                    line["pos"] = temp["pos"]
-                    line["neg"] = temp["neg"]
-                    line["neu"] = temp["neu"]
-                    line["compound"] = temp["compound"]
-                    line["created_utc"] = parse_date(
-                        line["created_utc"], format="epoch"
-                    )
-                    file.write(json.dumps(line) + "\n")
-            ## Update the progress bar
-            pbar.update(len(data_comments))
-        else:
-            ## Print out the strange status code and its message
-            print(
-                f"Something went wrong. The status code error was {data_comments.pop}."
-            )
-
-## Define the parameters and options
-source_url = "https://api.pushshift.io/reddit/search/submission/"
-payload = {"subreddit": "urbanplanning", "size": 100}
-
-## Collect first batch of data
-data = collect_data(source_url=source_url, payload=payload)
-
-## Open a file in write mode
-with open("submissions.jl", "w") as file:
-    ## Write out the data you already collected
-    for line in data:
+    line["created_utc"] = parse_date(line["created_utc"], format="epoch")
+    return line
+
+
+def process_submission(line, sentiment=True):
+    """
+    It computes the sentiment of the submission title (and selftext if there is one) and converts its creation date
+    into human readable format.
+
+    Parameters:
+    ===========
+    line: dict
+        A mapping with a submission returned by the Pushshift API.
+    sentiment: bool
+        If False, the sentiment is left to score_sentiment.py.
+    """
+    if sentiment:
         temp = vader.polarity_scores(line["title"])
         line["pos"] = temp["pos"]
         line["neg"] = temp["neg"]
         line["neu"] = temp["neu"]
         line["compound"] = temp["compound"]
-        if (
-            "selftext" in line
-            and len(line["selftext"]) > 0
-            and "[deleted]" not in line["selftext"]
-        ):
-            temp = vader.polarity_scores(line["selftext"])
-            line["pos_selftext"] = temp["pos"]
-            line["neg_selftext"] = temp["neg"]
-            line["neu_selftext"] = temp["neu"]
-            line["compound_selftext"] = temp["compound"]
-        line["created_utc"] = parse_date(line["created_utc"], format="epoch")
-        file.write(json.dumps(line) + "\n")
-    ## Set the prpogress bar
-    pbar = tqdm.tqdm(position=0, leave=True, initial=100)
-    ## Create a while-loop
-    while len(data) > 0:
-        ## Check if we got data from Reddit or a strange status code
-        if len(data[0].keys()) > 2:
-            ## Get the last collected data date in epoch time
-            after = parse_date(data[-1]["created_utc"])
-            ## Update the payload after field
-            payload["after"] = after
-            ## Collect the data
-            data = collect_data(source_url=source_url, payload=payload)
-            ## Write out the collected data to the file
-            for line in data:
-                if "created_utc" in line:
-                    ## Compute sentiment of the text
-                    temp = vader.polarity_scores(line["title"])
-                    line["pos"] = temp["pos"]
-                    line["neg"] = temp["neg"]
-                    line["neu"] = temp["neu"]
-                    line["compound"] = temp["compound"]
-                    if (
-                        "selftext" in line
-                        and len(line["selftext"]) > 0
-                        and "[deleted]" not in line["selftext"]
-                    ):
-                        temp = vader.polarity_scores(line["selftext"])
-                        line["pos_selftext"] = temp["pos"]
-                        line["neg_selftext"] = temp["neg"]
-                        line["neu_selftext"] = temp["neu"]
-                        line["compound_selftext"] = temp["compound"]
-                    line["created_utc"] = parse_date(
-                        line["created_utc"], format="epoch"
+    if (
+        sentiment
+        and "selftext" in line
+        and len(line["selftext"]) > 0
+        and "[deleted]" not in line["selftext"]
+    ):
+        temp = vader.polarity_scores(line["selftext"])
+        line["pos_selftext"] = temp["pos"]
+        line["neg_selftext"] = temp["neg"]
+        line["neu_selftext"] = temp["neu"]
+        line["compound_selftext"] = temp["compound"]
+    line["created_utc"] = parse_date(line["created_utc"], format="epoch")
+    return line
+
+
+def split_windows(after, before, window):
+    """
+    It splits the time range between after and before into consecutive windows. Each window is a tuple (start, end)
+    and covers the epoch times start <= created_utc < end.
+
+    Parameters:
+    ===========
+    after: int
+        The beginning of the time range in epoch time format.
+    before: int
+        The end of the time range in epoch time format.
+    window: int
+        The length of a single window in seconds.
+    """
+    return [
+        (start, min(start + window, before)) for start in range(after, before, window)
+    ]
+
+
+async def fetch_page(session, source_url, params, rate_limiter):
+    """
+    It sends a single request to the Pushshift endpoint through the shared session. Depending on the status code it
+    either returns the list of mappings, backs off and tries again, or raises a PushshiftError.
+
+    Parameters:
+    ===========
+    session: aiohttp.ClientSession
+        A session with the connection pool shared by all windows.
+    source_url: str
+        A string with url of the Pushshift endpoint.
+    params:
+        A mapping with parameters passed to the Pushshift API.
+    rate_limiter: RateLimiter
+        A rate limiter shared by all windows.
+    """
+    for attempt in range(rate_limiter.max_retries + 1):
+        await rate_limiter.acquire_async()
+        async with session.get(source_url, params=params) as response:
+            rate_limiter.update(response.headers)
+            if response.status == 200:
+                return json.loads(await response.text())["data"]
+            message = await response.text()
+            if response.status not in RETRY_STATUS_CODES:
+                break
+            rate_limiter.backoff(attempt=attempt, headers=response.headers)
+    raise PushshiftError(status=response.status, message=message)
+
+
+async def collect_window(session, source_url, payload, start, end, rate_limiter):
+    """
+    It pages through a single time window in ascending order of creation date and returns all the mappings
+    created within it. An error page raises a PushshiftError, so a window is never returned incomplete.
+
+    Parameters:
+    ===========
+    session: aiohttp.ClientSession
+        A session with the connection pool shared by all windows.
+    source_url: str
+        A string with url of the Pushshift endpoint.
+    payload:
+        A mapping with parameters passed to the Pushshift API.
+    start: int
+        The beginning of the window in epoch time format (inclusive).
+    end: int
+        The end of the window in epoch time format (exclusive).
+    rate_limiter: RateLimiter
+        A rate limiter shared by all windows.
+    """
+    params = {**payload, "sort": "asc", "sort_type": "created_utc"}
+    params["after"] = start - 1
+    params["before"] = end
+    size = int(params.get("size", 100))
+    data = []
+    while True:
+        page = await fetch_page(
+            session=session,
+            source_url=source_url,
+            params=params,
+            rate_limiter=rate_limiter,
+        )
+        if len(page) == 0:
+            break
+        data.extend(page)
+        if len(page) < size:
+            break
+        ## Step back one second so the mappings posted in the same second as the
+        ## last one are not lost. The duplicates are dropped when writing out.
+        after = int(page[-1]["created_utc"]) - 1
+        params["after"] = max(after, params["after"] + 1)
+    return data
+
+
+async def collect_range(
+    source_url,
+    payload,
+    path,
+    process,
+    after,
+    before,
+    window,
+    concurrency=4,
+    rate_limiter=rate_limiter,
+    checkpoint=None,
+    resume=False,
+    format="jsonl",
+):
+    """
+    It splits the time range into windows, collects many windows at once through a shared connection pool, and
+    writes out the results to a JSON line file (or a Parquet dataset partitioned by subreddit and month) in the order
+    of the windows and without duplicates.
+
+    Parameters:
+    ===========
+    source_url: str
+        A string with url of the Pushshift endpoint.
+    payload:
+        A mapping with parameters passed to the Pushshift API.
+    path: str
+        A path to the JSON line file.
+    process: callable
+        A function applied to each mapping before it is written out.
+    after: int
+        The beginning of the time range in epoch time format.
+    before: int
+        The end of the time range in epoch time format.
+    window: int
+        The length of a single window in seconds.
+    concurrency: int
+        The maximal number of windows (and requests) in flight at once.
+    rate_limiter: RateLimiter
+        A rate limiter shared by all windows which keeps the requests under the API limit.
+    checkpoint: Checkpoint
+        A checkpoint store which records the offset of the file and the end of the last window written out.
+    resume: bool
+        If True, it appends to the file and starts from the last window recorded in the checkpoint.
+    format: str
+        Either "jsonl" or "parquet".
+
+    Raises:
+    =======
+    PushshiftError
+        If a window failed. The windows before it are written out and checkpointed, the ones after it are not.
+    """
+    if checkpoint is None:
+        file, cursor = make_writer(format=format, path=path), None
+    else:
+        file, cursor = open_output(
+            path=path, checkpoint=checkpoint, resume=resume, format=format
+        )
+    if cursor is not None:
+        after = max(after, cursor)
+    windows = split_windows(after=after, before=before, window=window)
+    seen = set()
+    pending = {}
+    ready = {}
+    next_window = 0
+    next_write = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        with file:
+            pbar = tqdm.tqdm(total=len(windows), position=0, leave=True)
+            while next_write < len(windows):
+                ## Keep at most `concurrency` windows in flight and do not run too
+                ## far ahead of the oldest window which was not written out yet.
+                while (
+                    next_window < len(windows)
+                    and len(pending) < concurrency
+                    and next_window - next_write < 4 * concurrency
+                ):
+                    start, end = windows[next_window]
+                    task = asyncio.create_task(
+                        collect_window(
+                            session=session,
+                            source_url=source_url,
+                            payload=payload,
+                            start=start,
+                            end=end,
+                            rate_limiter=rate_limiter,
+                        )
                     )
-                    file.write(json.dumps(line) + "\n")
-            ## Update the progress bar
-            pbar.update(len(data))
-        else:
-            ## Print out the strange status code and its message
-            print(f"Something went wrong. The status code error was {data.pop}.")
+                    pending[task] = next_window
+                    next_window += 1
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index = pending.pop(task)
+                    try:
+                        ready[index] = task.result()
+                    except PushshiftError as error:
+                        ready[index] = error
+                ## Write out the consecutive windows which are already collected
+                while next_write in ready:
+                    data = ready.pop(next_write)
+                    if isinstance(data, PushshiftError):
+                        ## Stop at the first failed window, so the checkpoint keeps
+                        ## pointing at its start and a resumed run fetches it again
+                        for task in pending:
+                            task.cancel()
+                        await asyncio.gather(*pending, return_exceptions=True)
+                        pbar.close()
+                        start, end = windows[next_write]
+                        print(
+                            f"The window {start}-{end} failed, run again with --resume to collect it."
+                        )
+                        raise data
+                    for line in data:
+                        if line["id"] in seen:
+                            continue
+                        seen.add(line["id"])
+                        file.write(process(line))
+                    if checkpoint is not None:
+                        commit_output(
+                            file=file,
+                            checkpoint=checkpoint,
+                            cursor=windows[next_write][1],
+                        )
+                    next_write += 1
+                    pbar.update(1)
+            pbar.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect comments and submissions from a subreddit through the Pushshift API."
+    )
+    parser.add_argument("--subreddit", default="urbanplanning")
+    parser.add_argument("--after", default=START_DATE)
+    parser.add_argument("--before", default=time.strftime("%Y-%m-%d %H:%M:%S"))
+    parser.add_argument(
+        "--window-days", type=float, default=30, help="length of a time window"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="number of windows in flight"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="number of requests per second"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="append to the files and continue from the last checkpoint",
+    )
+    parser.add_argument("--checkpoint", default="get_data.checkpoint")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument(
+        "--no-sentiment",
+        dest="sentiment",
+        action="store_false",
+        help="skip the sentiment and score the files later with score_sentiment.py",
+    )
+    args = parser.parse_args()
+    limiter = RateLimiter(rate=args.rate, burst=args.concurrency)
+    checkpoint = Checkpoint(args.checkpoint)
+
+    payload = {"subreddit": args.subreddit, "size": 100}
+    after = int(parse_date(args.after))
+    before = int(parse_date(args.before))
+    window = max(int(args.window_days * 24 * 60 * 60), 1)
+
+    ## Collect comments
+    asyncio.run(
+        collect_range(
+            source_url=COMMENTS_URL,
+            payload=payload,
+            path="comments.jl",
+            process=functools.partial(process_comment, sentiment=args.sentiment),
+            after=after,
+            before=before,
+            window=window,
+            concurrency=args.concurrency,
+            rate_limiter=limiter,
+            checkpoint=checkpoint,
+            resume=args.resume,
+            format=args.format,
+        )
+    )
+    ## Collect submissions
+    asyncio.run(
+        collect_range(
+            source_url=SUBMISSIONS_URL,
+            payload=payload,
+            path="submissions.jl",
+            process=functools.partial(process_submission, sentiment=args.sentiment),
+            after=after,
+            before=before,
+            window=window,
+            concurrency=args.concurrency,
+            rate_limiter=limiter,
+            checkpoint=checkpoint,
+            resume=args.resume,
+            format=args.format,
+        )
+    )
+    checkpoint.close()
+
+
+if __name__ == "__main__":
+    main()
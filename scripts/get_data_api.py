@@ -3,21 +3,48 @@ import praw
 import os
 from datetime import datetime
 import json
-import pandas as pd
+from itertools import islice
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
 from tqdm import tqdm
-import sys
+import argparse
+from rate_limit import RateLimiter, RateLimitedRequestor
+from author_cache import AuthorCache
 
 HERE = Path(__file__).absolute().parent.parent
 DATA = HERE / "data"
 RAW = DATA / "raw"
 XLSX = DATA / "xlsx"
+PARQUET = DATA / "parquet"
+## Columns of the comments with the author flattened into author_* columns
+COMMENT_SCHEMA = pa.schema(
+    [
+        ("body", pa.string()),
+        ("score", pa.int64()),
+        ("link", pa.string()),
+        ("author_name", pa.string()),
+        ("author_karma", pa.int64()),
+        ("author_created_utc", pa.string()),
+        ("author_has_verified_email", pa.bool_()),
+        ("author_is_gold", pa.bool_()),
+        ("created_utc", pa.string()),
+        ## False (0) or the date of the last edit in epoch time format
+        ("edited", pa.float64()),
+        ("is_submitter", pa.bool_()),
+    ]
+)
 comment_id = "uhcdh5"
 client_id = os.getenv("Reddit_Client_Id")
 client_secret = os.getenv("Reddit_Client_Secret")
 password = os.getenv("Reddit_password")
 user_agent = os.getenv("Reddit_User_Agent")
 username = os.getenv("Reddit_Username")
+## Reddit allows 100 requests per minute for OAuth clients
+rate_limiter = RateLimiter(rate=100 / 60, burst=5)
+## Every author profile is fetched once and reused for all their comments
+author_cache = AuthorCache()
 
 reddit = praw.Reddit(
     client_id=client_id,
@@ -25,6 +52,8 @@ reddit = praw.Reddit(
     password=password,
     user_agent=user_agent,
     username=username,
+    requestor_class=RateLimitedRequestor,
+    requestor_kwargs={"rate_limiter": rate_limiter},
 )
 
 
@@ -43,7 +72,9 @@ def convert_date(date_float: float) -> str:
     return datetime.fromtimestamp(date_float).strftime("%d-%m-%Y %H:%M:%S")
 
 
-def get_data(comment_id: str, path: str = RAW) -> None:
+def get_data(
+    comment_id: str, path: str = RAW, author_cache: AuthorCache = author_cache
+) -> None:
     """
     It downloads comment from a given submission/comment and
     writes it out to JSON line file at path.
@@ -52,29 +83,37 @@ def get_data(comment_id: str, path: str = RAW) -> None:
         comment_id (str): a string with a submission/comment id from
         which you want to download comments.
         path (str): a path to the data folder.
+        author_cache (AuthorCache): a cache of author profiles, so
+        each author is fetched only once.
     """
     submission = reddit.submission(comment_id)
     submission.comments.replace_more(limit=None)
+    comments = submission.comments.list()
+    ## Fetch the authors in bulk if partial profiles are good enough
+    author_cache.prefetch(
+        reddit,
+        {
+            comment.author.name: vars(comment).get("author_fullname")
+            for comment in comments
+            if comment.author is not None
+        },
+    )
     path = path / (comment_id + "_comments.jsonl")
     print(f"Processing submission {submission.title}.")
     with open(path, "w") as file:
-        for comment in tqdm(submission.comments.list()):
+        for comment in tqdm(comments):
             temp_dict = {}
             temp_dict["body"] = comment.body
             if temp_dict["body"] == "[deleted]":
                 continue
             temp_dict["score"] = comment.score
             temp_dict["link"] = comment.permalink
-            try:
+            profile = author_cache.get(comment.author)
+            if profile is not None:
                 temp_dict["author"] = {
-                    "name": comment.author.name,
-                    "karma": comment.author.comment_karma,
-                    "created_utc": convert_date(comment.author.created_utc),
-                    "has_verified_email": comment.author.has_verified_email,
-                    "is_gold": comment.author.is_gold,
+                    **profile,
+                    "created_utc": convert_date(profile["created_utc"]),
                 }
-            except:  # noqa
-                pass
             temp_dict["created_utc"] = convert_date(comment.created_utc)
             temp_dict["edited"] = comment.edited
             temp_dict["is_submitter"] = comment.is_submitter
@@ -82,26 +121,119 @@ def get_data(comment_id: str, path: str = RAW) -> None:
             file.write(json.dumps(temp_dict) + "\n")
 
 
+def flatten(record: dict) -> dict:
+    """
+    Flattens the nested author mapping into author_* keys.
+
+    Args:
+        record (dict): a mapping with a comment.
+
+    Returns:
+        dict: a flat mapping with the comment.
+    """
+    flat = {key: value for key, value in record.items() if key != "author"}
+    for key, value in record.get("author", {}).items():
+        flat["author_" + key] = value
+    return flat
+
+
+def read_chunks(path: str, chunksize: int = 10_000):
+    """
+    Reads a JSON line file in chunks, so only one chunk is kept in memory.
+
+    Args:
+        path (str): a path to the JSON line file.
+        chunksize (int): number of lines in a chunk.
+
+    Yields:
+        list: a list of flat mappings, compare flatten.
+    """
+    with open(path, "r") as file:
+        while chunk := list(islice(file, chunksize)):
+            yield [flatten(json.loads(line)) for line in chunk]
+
+
 def convert_to_excel(
-    comment_id: str, input_path: str = RAW, output_path: str = XLSX
+    comment_id: str,
+    input_path: str = RAW,
+    output_path: str = XLSX,
+    chunksize: int = 10_000,
 ) -> None:
     """
-    Converts a JSON line file into an Excel spreadsheet.
+    Converts a JSON line file into an Excel spreadsheet. It streams the
+    rows with openpyxl in write-only mode, so the memory use does not
+    depend on the size of the file.
 
     Args:
         input_path (str): a path to a raw data folder.
         output_path (str): a path to a processed data folder.
         comment_id (str): name of the file to process without extension.
+        chunksize (int): number of lines read at once.
     """
     input_path = input_path / (comment_id + "_comments.jsonl")
     output_path = output_path / (comment_id + "_comments.xlsx")
-    with open(input_path, "r") as file:
-        temp = [json.loads(line) for line in file.readlines()]
-    pd.DataFrame.from_records(temp).to_excel(output_path)
+    columns = COMMENT_SCHEMA.names
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([None] + columns)
+    n = 0
+    for chunk in read_chunks(input_path, chunksize=chunksize):
+        for row in chunk:
+            sheet.append([n] + [row.get(column) for column in columns])
+            n += 1
+    workbook.save(output_path)
+
+
+def convert_to_parquet(
+    comment_id: str,
+    input_path: str = RAW,
+    output_path: str = PARQUET,
+    chunksize: int = 10_000,
+) -> None:
+    """
+    Converts a JSON line file into a Parquet file. Every chunk is written
+    out as a separate row group, so the memory use does not depend on the
+    size of the file.
+
+    Args:
+        input_path (str): a path to a raw data folder.
+        output_path (str): a path to a processed data folder.
+        comment_id (str): name of the file to process without extension.
+        chunksize (int): number of lines in a row group.
+    """
+    input_path = input_path / (comment_id + "_comments.jsonl")
+    output_path.mkdir(parents=True, exist_ok=True)
+    output_path = output_path / (comment_id + "_comments.parquet")
+    with pq.ParquetWriter(output_path, COMMENT_SCHEMA) as writer:
+        for chunk in read_chunks(input_path, chunksize=chunksize):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=COMMENT_SCHEMA))
 
 
 # %%
 if __name__ == "__main__":
-    for comment_id in sys.argv[1:]:
-        get_data(comment_id=comment_id, path=RAW)
-        convert_to_excel(input_path=RAW, output_path=XLSX, comment_id=comment_id)
+    parser = argparse.ArgumentParser(
+        description="Download all comments from the given submissions."
+    )
+    parser.add_argument("comment_ids", nargs="+")
+    parser.add_argument("--author-cache", default=str(DATA / "authors.json"))
+    parser.add_argument(
+        "--partial-authors",
+        action="store_true",
+        help="fetch authors in bulk without has_verified_email and is_gold",
+    )
+    parser.add_argument("--format", choices=["xlsx", "parquet"], default="xlsx")
+    args = parser.parse_args()
+    author_cache = AuthorCache(path=args.author_cache, partial_ok=args.partial_authors)
+    for comment_id in args.comment_ids:
+        get_data(comment_id=comment_id, path=RAW, author_cache=author_cache)
+        if args.format == "parquet":
+            convert_to_parquet(
+                input_path=RAW, output_path=PARQUET, comment_id=comment_id
+            )
+        else:
+            convert_to_excel(input_path=RAW, output_path=XLSX, comment_id=comment_id)
+    author_cache.save()
+    print(
+        f"{author_cache.requests} author requests, "
+        f"{len(author_cache.failures)} authors could not be fetched."
+    )
@@ -0,0 +1,607 @@
+# %%
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+
+import numpy as np
+import pandas as pd
+from gensim.corpora import Dictionary
+from gensim.models import LdaModel
+from scipy import sparse
+
+from lemmatize import BATCH_SIZE, lemmatize_jsonl
+
+# %%
+## Define globals
+## The parameters of the models of run_lda_models
+LDA_PARAMS = {
+    "alpha": "asymmetric",
+    "eta": "auto",
+    "iterations": 500,
+    "passes": 20,
+    "eval_every": None,
+    "random_state": 1044,
+    "per_word_topics": True,
+}
+## Number of documents whose topics are inferred at once
+CHUNKSIZE = 2000
+## Keys with the id of a comment (the Pushshift dumps have id, the comments
+## collected with PRAW only their permalink)
+ID_KEYS = ["id", "link"]
+
+
+# %%
+## Define functions
+def dictionary_version(dictionary) -> str:
+    """
+    Returns a short hash of the token to id mapping of a dictionary, so a
+    filtered or extended dictionary gets a new bag-of-words cache.
+
+    Args:
+        dictionary (gensim.corpora.dictionary.Dictionary): a dictionary.
+
+    Returns:
+        str: the hash.
+    """
+    token2id = json.dumps(sorted(dictionary.token2id.items()))
+    return blake2b(token2id.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def build_bow_matrix(docs, num_terms) -> sparse.csr_matrix:
+    """
+    Collects the bag-of-words vectors of the documents in a sparse matrix with
+    one row per document.
+
+    Args:
+        docs (iterable): lists of tuples with the id of a token and its frequency.
+        num_terms (int): number of unique tokens in the dictionary.
+
+    Returns:
+        scipy.sparse.csr_matrix: a matrix of shape (num_documents, num_terms).
+    """
+    indptr = [0]
+    indices = []
+    data = []
+    for doc in docs:
+        for token_id, count in doc:
+            indices.append(token_id)
+            data.append(count)
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (
+            np.array(data, dtype=np.int32),
+            np.array(indices, dtype=np.int32),
+            np.array(indptr, dtype=np.int64),
+        ),
+        shape=(len(indptr) - 1, num_terms),
+    )
+
+
+# %%
+## Define classes
+class MyCorpus:
+    """
+    A class that represents a corpus and has usefull methods defined.
+
+    """
+
+    def __init__(
+        self, path, key="content", nlp=None, n_process=1, batch_size=BATCH_SIZE
+    ):
+        """
+        Reads from a JSON line file. Tokenizes and lemmatizes
+        the text under key. It writes out the new JSON line
+        file with a new field -- tokens.
+        Args:
+            path (str): a path to a JSON line.
+            key (str): a key with the content to lemmatize.
+            nlp (spacy.language.Language, optional): a spaCy pipeline. Defaults
+            to None (pt_core_news_lg without the parser and NER).
+            n_process (int, optional): number of processes which lemmatize the
+            texts. Defaults to 1.
+            batch_size (int, optional): number of texts sent to a process at
+            once. Defaults to BATCH_SIZE.
+        """
+        self._path_original = path
+        self._key = key
+        self._dictionary = None
+        self._bow = None
+        self._num_terms = None
+        self._path = path.replace(".", "_NLP.")
+        lemmatize_jsonl(
+            self._path_original,
+            self._path,
+            key=self._key,
+            nlp=nlp,
+            n_process=n_process,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def from_tokens(cls, path, key="content"):
+        """
+        Creates a corpus from a JSON line file which was lemmatized before
+        (the _NLP file), without lemmatizing it again.
+
+        Args:
+            path (str): a path to the JSON line file with the tokens.
+            key (str): a key with the content.
+
+        Returns:
+            MyCorpus: the corpus.
+        """
+        corpus = cls.__new__(cls)
+        corpus._path_original = path.replace("_NLP.", ".")
+        corpus._key = key
+        corpus._dictionary = None
+        corpus._bow = None
+        corpus._num_terms = None
+        corpus._path = path
+        return corpus
+
+    def set_dictionary(self, dictionary, cache=True, num_terms=None):
+        """
+        Assigns a gensim.corpora.dictionary.Dictioanry object
+        to self._dictionary. The bag-of-words vectors of the corpus are
+        computed once per version of the dictionary and kept in a sparse
+        matrix (written out next to the _NLP file as .npz), so the training
+        passes do not read and parse the JSON line file again.
+
+        Args:
+            dictionary (gensim.corpora.dictionary.Dictionary): a dictionary
+            that stores the frequencies of unique tokens in the corpus.
+            cache (bool, optional): whether to build (or load) the bag-of-words
+            cache. Defaults to True.
+            num_terms (int, optional): keep only the tokens with a smaller id,
+            e.g. the vocabulary of a model trained before the dictionary was
+            extended. Defaults to None (all the tokens).
+        """
+        self._dictionary = dictionary
+        self._num_terms = num_terms
+        self._bow = None
+        if cache:
+            self._bow = self.load_bow()
+            if num_terms is not None:
+                self._bow = self._bow[:, :num_terms]
+
+    def get_bow_path(self):
+        """
+        Returns the path to the bag-of-words cache of the current dictionary.
+
+        Returns:
+            str: a path to the .npz file.
+        """
+        root, _ = os.path.splitext(self._path)
+        return f"{root}_BOW_{dictionary_version(self._dictionary)}.npz"
+
+    def load_bow(self):
+        """
+        Loads the bag-of-words cache of the current dictionary. It is built
+        if it does not exist or is older than the _NLP file.
+
+        Returns:
+            scipy.sparse.csr_matrix: a matrix of shape (num_documents, num_terms).
+        """
+        path = self.get_bow_path()
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+            self._path
+        ):
+            return sparse.load_npz(path).tocsr()
+        docs = (self._dictionary.doc2bow(doc) for doc in self.get_tokens())
+        bow = build_bow_matrix(docs, num_terms=len(self._dictionary))
+        sparse.save_npz(path, bow)
+        return bow
+
+    def get_tokens(self):
+        """
+        It takes the path to a JSON line file with comments from Reddit and
+        returns a generator that yields tokens for each comment.
+
+        Yields:
+            list : list of tokens for a comment from Reddit.
+        """
+        with open(self._path, "r") as file:
+            for doc in file:
+                temp = json.loads(doc)
+                yield temp["tokens"]
+
+    def get_bow(self):
+        """
+        It takes a dictionary with frequencies of unique tokens in the corpus
+        and for each list of tokens returns a list of tuples that denote the
+        id of a given token and its frequency in a given document.
+
+        Raises:
+            ValueError: if the dictionary was not assigned to self._dictionary.
+
+        Yields:
+            list : a list of tuples that denote the id of a given token and its
+            frequency in a given document.
+        """
+        if self._dictionary:
+            for doc in self.get_tokens():
+                bow = self._dictionary.doc2bow(doc)
+                if self._num_terms is not None:
+                    bow = [(i, count) for i, count in bow if i < self._num_terms]
+                yield bow
+        else:
+            raise ValueError("Dictionary has the value of None")
+
+    def __iter__(self):
+        """
+        Yields:
+            list : a list of tuples that denote the id of a given token and
+            its frequency in a given document.
+        """
+        if self._bow is None:
+            yield from self.get_bow()
+            return
+        indptr = self._bow.indptr
+        indices = self._bow.indices
+        data = self._bow.data
+        ## Only the row which is yielded is converted to Python numbers
+        for start, end in zip(indptr[:-1], indptr[1:]):
+            yield list(zip(indices[start:end].tolist(), data[start:end].tolist()))
+
+    def __len__(self):
+        """
+        Returns:
+            int: number of documents in the corpus.
+        """
+        if self._bow is not None:
+            return self._bow.shape[0]
+        with open(self._path, "r") as file:
+            return sum(1 for _ in file)
+
+    def get_topic_matrix(self, model, chunksize=CHUNKSIZE):
+        """
+        Infers the topics of all the documents in chunks of the bag-of-words
+        corpus, instead of one document at a time.
+
+        Args:
+            model (gensim.models.ldamodel.LdaModel): Latent Dirchlet Allocation
+            model.
+            chunksize (int, optional): number of documents inferred at once.
+            Defaults to CHUNKSIZE.
+
+        Returns:
+            np.ndarray: the probability of every topic (columns) for every
+            document (rows).
+        """
+        matrices = []
+        chunk = []
+        for doc in self:
+            chunk.append(doc)
+            if len(chunk) == chunksize:
+                matrices.append(model.inference(chunk)[0])
+                chunk = []
+        if chunk:
+            matrices.append(model.inference(chunk)[0])
+        if not matrices:
+            return np.empty((0, model.num_topics))
+        gamma = np.vstack(matrices)
+        return gamma / gamma.sum(axis=1, keepdims=True)
+
+    def get_topics(self, model, chunksize=CHUNKSIZE):
+        """
+        It takes a model and returns a generator that yields a mapping for each
+        comment from Reddit. Among other keys it returns the most probable topic
+        based on the LDA model provided and its probability.
+
+        Args:
+            model (gensim.models.ldamodel.LdaModel): Latent Dirchlet Allocation
+            model.
+            chunksize (int, optional): number of documents inferred at once.
+            Defaults to CHUNKSIZE.
+
+        Yields:
+            dict : a mapping for each comment from Reddit. Among other keys it
+            returns the most prpobable topic based on the LDA model provided and
+            its probability.
+        """
+        probs = self.get_topic_matrix(model, chunksize=chunksize)
+        topics = probs.argmax(axis=1)
+        topic_probs = probs[np.arange(len(probs)), topics]
+        with open(self._path, "r") as file:
+            for doc, topic, prob in zip(file, topics, topic_probs):
+                temp = json.loads(doc)
+                temp["topic"] = int(topic) + 1
+                temp["topic_prob"] = float(prob)
+                yield temp
+
+    def get_topics_table(self, model, chunksize=CHUNKSIZE):
+        """
+        Returns a data frame with the comments from Reddit, their most probable
+        topic, its probability and the probability of every topic (topic_1,
+        topic_2, ...).
+
+        Args:
+            model (gensim.models.ldamodel.LdaModel): Latent Dirchlet Allocation
+            model.
+            chunksize (int, optional): number of documents inferred at once.
+            Defaults to CHUNKSIZE.
+
+        Returns:
+            pd.DataFrame: a row for each comment from Reddit.
+        """
+        probs = self.get_topic_matrix(model, chunksize=chunksize)
+        table = pd.read_json(self._path, lines=True, dtype=False)
+        topics = probs.argmax(axis=1)
+        table["topic"] = topics + 1
+        table["topic_prob"] = probs[np.arange(len(probs)), topics]
+        columns = [f"topic_{i + 1}" for i in range(probs.shape[1])]
+        return pd.concat(
+            [table, pd.DataFrame(probs, columns=columns, index=table.index)], axis=1
+        )
+
+
+# %%
+class MyModel(LdaModel):
+    """
+    Subclass of gensim.models.LdaModel.
+    """
+
+    def get_coherence(self, corpus):
+        """
+        Returns the average coherence measure for the given model.
+
+        Args:
+            corpus (MyCorpus): A corpus on which the model is computed.
+
+        Returns:
+            float: the average coherence measure for the given model.
+        """
+        top_topics = self.top_topics(corpus)
+        return sum([t[1] for t in top_topics]) / len(top_topics)
+
+    def get_top_tokens(self, corpus):
+        """
+        Returns a list of dictionaries that depict the most probable
+        tokens for each topic.
+
+        Args:
+            corpus (MyCorpus): A corpus on which the model was computed.
+
+        Returns:
+            list: list of dicitionaries that depict the most probable
+            tokens fro each topic.
+        """
+        top_tokens = self.top_topics(corpus)
+        return [{key: value for value, key in t[0]} for t in top_tokens]
+
+    def get_summary(self, corpus):
+        """
+        Returns the average coherence measure and the most probable tokens for
+        each topic. The topics are ranked only once for both.
+
+        Args:
+            corpus (MyCorpus): A corpus on which the model was computed.
+
+        Returns:
+            tuple: the average coherence measure and the list of dictionaries
+            with the most probable tokens for each topic.
+        """
+        top_topics = self.top_topics(corpus)
+        coherence = sum([t[1] for t in top_topics]) / len(top_topics)
+        top_tokens = [{key: value for value, key in t[0]} for t in top_topics]
+        return coherence, top_tokens
+
+
+# %%
+def train_lda_model(corpus, id2word, num_topics, path, params):
+    """
+    Computes a single lda model, writes it out to disk and summarizes it. It
+    is defined at module level so it can run in a separate process.
+
+    Args:
+        corpus (MyCorpus): A stream of document vectors.
+        id2word (dict): a mapping from the ids to the tokens.
+        num_topics (int): the number of topics.
+        path (str): a path to write the model to.
+        params (dict): other parameters of the model.
+
+    Returns:
+        dict: the number of topics, the coherence measure, the path and the most
+        probable tokens for each topic.
+    """
+    model = MyModel(corpus=corpus, id2word=id2word, num_topics=num_topics, **params)
+    model.save(path)
+    coherence, top_tokens = model.get_summary(corpus=corpus)
+    return {
+        "num_topics": num_topics,
+        "coherence": coherence,
+        "path": path,
+        "top_tokens": json.dumps(top_tokens, ensure_ascii=False),
+    }
+
+
+def run_lda_models(
+    corpus,
+    dictionary,
+    min_topics,
+    max_topics,
+    step=1,
+    name="lda",
+    processes=1,
+    output="models",
+    **kwargs,
+):
+    """
+    Computes a sequence of lda models for a given corpus and dictionary. The
+    numbers of topics are spread over a pool of processes. It writes out the
+    models and a table with the coherence measure of every model to disk.
+
+    Args:
+        corpus (MyModel): A stream of document vectors or sparse matrix of shape (num_documents, num_terms).
+        dictionary (dict): a mapping that assigns id to unique tokens from the corpus.
+        min_topics (int): the smallest number of topics to compute.
+        max_topics (int): the highest number of topics to compute.
+        step (int, optional): the size of the break inbetween computed models. Defaults to 1.
+        name (str, optional): the name of the models. Defaults to "lda".
+        processes (int, optional): the number of models computed at the same time. Defaults to 1.
+        output (str, optional): a directory for the models, the dictionary and the table. Defaults to "models".
+        **kwargs: parameters of the models which replace LDA_PARAMS.
+
+    Returns:
+        pd.DataFrame: the name, number of topics, coherence measure, path and the
+        most probable tokens of every model.
+    """
+    ## The id2token mapping of a Dictionary is filled on the first lookup
+    dictionary[0]
+    id2word = dictionary.id2token
+    os.makedirs(output, exist_ok=True)
+    ## The notebooks write the figures of the topics to png
+    os.makedirs("png", exist_ok=True)
+    ## The dictionary is needed to update the models with new comments
+    dictionary.save(os.path.join(output, f"{name}.dict"))
+    params = {**LDA_PARAMS, **kwargs}
+    args = [
+        (
+            corpus,
+            id2word,
+            num_topic,
+            os.path.join(output, f"{name}-{num_topic}"),
+            params,
+        )
+        for num_topic in range(min_topics, max_topics + 1, step)
+    ]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(train_lda_model, *zip(*args)))
+    else:
+        results = [train_lda_model(*arg) for arg in args]
+    table = pd.DataFrame.from_records(results)
+    table.insert(0, "name", name)
+    table.to_csv(os.path.join(output, f"{name}.csv"), index=False)
+    print(table[["name", "num_topics", "coherence"]].to_string(index=False))
+    return table
+
+
+def update_lda_model(
+    model_path,
+    dictionary_path,
+    path,
+    key="content",
+    topics_path=None,
+    chunksize=CHUNKSIZE,
+    id_key=None,
+    **kwargs,
+):
+    """
+    Updates a saved lda model with new comments instead of computing it again.
+    Only the new comments are lemmatized. The dictionary is extended with their
+    tokens (and saved for the next full run), but the model keeps its vocabulary,
+    so the tokens it has not seen are left out of the update. The topics of the
+    new comments are appended to a table with a fixed set of columns (id_key,
+    topic, topic_prob, topic_1, topic_2, ...), so the rows of every update line
+    up with its header. Nothing is written out if the comments have no id.
+
+    Args:
+        model_path (str): a path to the saved model (it is overwritten).
+        dictionary_path (str): a path to the saved dictionary (it is overwritten).
+        path (str): a path to a JSON line file with only the new comments.
+        key (str, optional): a key with the content to lemmatize. Defaults to "content".
+        topics_path (str, optional): a path to the CSV file the topics of the new
+        comments are appended to. Defaults to None (model_path + "-topics.csv").
+        chunksize (int, optional): number of documents inferred at once.
+        Defaults to CHUNKSIZE.
+        id_key (str, optional): a key with the id of a comment. Defaults to None
+        (the first key of ID_KEYS the comments have).
+        **kwargs: arguments of MyCorpus, e.g. n_process.
+
+    Returns:
+        pd.DataFrame: the new comments with their topics.
+
+    Raises:
+        KeyError: if the comments have no id_key (or none of ID_KEYS).
+    """
+    model = MyModel.load(model_path)
+    dictionary = Dictionary.load(dictionary_path)
+    corpus = MyCorpus(path, key=key, **kwargs)
+    dictionary.add_documents(corpus.get_tokens(), prune_at=None)
+    corpus.set_dictionary(dictionary, num_terms=model.num_terms)
+    model.update(list(corpus))
+    table = corpus.get_topics_table(model, chunksize=chunksize)
+    keys = [id_key] if id_key else ID_KEYS
+    id_key = next((_ for _ in keys if _ in table.columns), None)
+    if id_key is None:
+        raise KeyError(f"The comments in {path} have none of the keys {keys}.")
+    ## The model and the dictionary are saved only once the table can be written
+    model.save(model_path)
+    dictionary.save(dictionary_path)
+    topics_path = topics_path or f"{model_path}-topics.csv"
+    columns = [id_key, "topic", "topic_prob"]
+    columns += [f"topic_{i + 1}" for i in range(model.num_topics)]
+    table[columns].to_csv(
+        topics_path, mode="a", header=not os.path.exists(topics_path), index=False
+    )
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute lda models for a range of numbers of topics or update a model with new comments."
+    )
+    parser.add_argument(
+        "path",
+        help="a path to the lemmatized JSON line file (_NLP), or to the new comments with --update",
+    )
+    parser.add_argument("--name", default="lda")
+    parser.add_argument("--min-topics", type=int, default=2)
+    parser.add_argument("--max-topics", type=int, default=15)
+    parser.add_argument("--step", type=int, default=1)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of models computed at the same time (or processes which lemmatize with --update)",
+    )
+    parser.add_argument("--output", default="models")
+    parser.add_argument("--no-below", type=int, default=5)
+    parser.add_argument("--no-above", type=float, default=0.5)
+    parser.add_argument(
+        "--update",
+        metavar="MODEL",
+        help="a path to a saved model to update with the new comments in path",
+    )
+    parser.add_argument(
+        "--dictionary",
+        help="a path to the saved dictionary of the model, by default <output>/<name>.dict",
+    )
+    parser.add_argument("--key", default="content")
+    parser.add_argument(
+        "--id-key",
+        help="a key with the id of a comment with --update, by default the first of id and link",
+    )
+    args = parser.parse_args()
+    if args.update:
+        update_lda_model(
+            args.update,
+            args.dictionary or os.path.join(args.output, f"{args.name}.dict"),
+            args.path,
+            key=args.key,
+            id_key=args.id_key,
+            n_process=args.processes,
+        )
+        return
+    corpus = MyCorpus.from_tokens(args.path)
+    dictionary = Dictionary(corpus.get_tokens())
+    dictionary.filter_extremes(no_below=args.no_below, no_above=args.no_above)
+    corpus.set_dictionary(dictionary)
+    run_lda_models(
+        corpus=corpus,
+        dictionary=dictionary,
+        min_topics=args.min_topics,
+        max_topics=args.max_topics,
+        step=args.step,
+        name=args.name,
+        processes=args.processes,
+        output=args.output,
+    )
+
+
+# %%
+if __name__ == "__main__":
+    main()
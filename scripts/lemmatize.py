@@ -0,0 +1,170 @@
+# %%
+import argparse
+import json
+import sys
+
+import spacy
+
+# %%
+## Define globals
+MODEL = "pt_core_news_lg"
+## Only the tagger, the morphologizer, the attribute ruler and the lemmatizer
+## are needed for the lemmas, the dependency parser and NER are never used
+DISABLE = ["parser", "ner"]
+BATCH_SIZE = 1000
+
+
+# %%
+## Define functions
+def load_nlp(model: str = MODEL, disable: list = DISABLE):
+    """
+    Loads a spaCy pipeline without the components which are not needed to
+    lemmatize the texts.
+
+    Args:
+        model (str, optional): name of the spaCy model. Defaults to MODEL.
+        disable (list, optional): components to leave out. Defaults to DISABLE.
+
+    Returns:
+        spacy.language.Language: the pipeline.
+    """
+    return spacy.load(model, disable=disable)
+
+
+def is_kept(token) -> bool:
+    """
+    Checks whether a token is kept in the tokens of a document. Stop words,
+    punctuation, digits, urls, e-mails, very short and very long tokens and
+    lemmas which are not alphabetic are left out.
+
+    Args:
+        token (spacy.tokens.Token): a token of a document.
+
+    Returns:
+        bool: True if the token is kept.
+    """
+    is_stop = (
+        token.is_stop
+        or token.is_punct
+        or token.is_space
+        or token.is_bracket
+        or token.is_currency
+        or token.is_digit
+        or token.is_quote
+        or token.like_url
+        or token.like_email
+        or len(token) < 2
+        or len(token) > 20
+        or (not token.lemma_.isalpha())
+    )
+    return not is_stop
+
+
+def get_tokens(doc) -> list:
+    """
+    Returns the lowercase lemmas of the tokens of a document which are kept.
+
+    Args:
+        doc (spacy.tokens.Doc): a processed document.
+
+    Returns:
+        list: list of lemmas.
+    """
+    return [token.lemma_.lower() for token in doc if is_kept(token)]
+
+
+def read_records(path: str, key: str = "content"):
+    """
+    Reads a JSON line file lazily and skips the deleted texts.
+
+    Args:
+        path (str): a path to a JSON line file.
+        key (str, optional): a key with the content to lemmatize. Defaults to "content".
+
+    Yields:
+        tuple: the text and the whole mapping of a line.
+    """
+    with open(path, "r") as file:
+        for line in file:
+            temp_dict = json.loads(line)
+            if temp_dict[key] == "[deleted]":
+                continue
+            yield temp_dict[key], temp_dict
+
+
+def lemmatize_jsonl(
+    path: str,
+    output: str,
+    key: str = "content",
+    nlp=None,
+    n_process: int = 1,
+    batch_size: int = BATCH_SIZE,
+) -> int:
+    """
+    Tokenizes and lemmatizes the text under key of every line of a JSON line
+    file and writes out the new JSON line file with a new field -- tokens. The
+    texts are streamed through nlp.pipe in batches spread over n_process
+    processes and every line is written as soon as it is processed, so the
+    corpus never has to fit in memory.
+
+    Args:
+        path (str): a path to a JSON line file.
+        output (str): a path to the new JSON line file.
+        key (str, optional): a key with the content to lemmatize. Defaults to "content".
+        nlp (spacy.language.Language, optional): a spaCy pipeline. Defaults to
+        None (load_nlp()).
+        n_process (int, optional): number of processes. Defaults to 1.
+        batch_size (int, optional): number of texts sent to a process at once.
+        Defaults to BATCH_SIZE.
+
+    Returns:
+        int: number of lines written out.
+    """
+    if nlp is None:
+        nlp = load_nlp()
+    n = 0
+    with open(output, "w") as file:
+        docs = nlp.pipe(
+            read_records(path, key=key),
+            as_tuples=True,
+            n_process=n_process,
+            batch_size=batch_size,
+        )
+        for doc, temp_dict in docs:
+            temp_dict["tokens"] = get_tokens(doc)
+            file.write(json.dumps(temp_dict) + "\n")
+            n += 1
+            if n % batch_size == 0:
+                sys.stdout.write(f"\rLine {n} processed")
+                sys.stdout.flush()
+    sys.stdout.write(f"\rLine {n} processed\n")
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lemmatize the texts of a JSON line file with spaCy."
+    )
+    parser.add_argument("path", help="a path to a JSON line file")
+    parser.add_argument("--key", default="content", help="a key with the content")
+    parser.add_argument(
+        "--output", help="a path to the new JSON line file, by default *_NLP.*"
+    )
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    output = args.output or args.path.replace(".", "_NLP.")
+    lemmatize_jsonl(
+        args.path,
+        output,
+        key=args.key,
+        nlp=load_nlp(args.model),
+        n_process=args.processes,
+        batch_size=args.batch_size,
+    )
+
+
+# %%
+if __name__ == "__main__":
+    main()
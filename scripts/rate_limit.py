@@ -0,0 +1,224 @@
+# %%
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from prawcore import Requestor
+
+# %%
+## Define globals
+RETRY_STATUS_CODES = (429, 502, 503, 504, 523)
+
+
+# %%
+## Define functions
+def parse_retry_after(headers) -> float | None:
+    """Reads the number of seconds to wait from the Retry-After header.
+
+    Parameters
+    ----------
+    headers
+        a case-insensitive mapping with the response headers.
+
+    Returns
+    -------
+        number of seconds to wait or None if the header is missing or malformed.
+    """
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit(headers) -> tuple[float, float] | None:
+    """Reads the remaining budget and the seconds until it resets from the
+    X-Ratelimit-Remaining and X-Ratelimit-Reset headers (used by Reddit).
+
+    Parameters
+    ----------
+    headers
+        a case-insensitive mapping with the response headers.
+
+    Returns
+    -------
+        a tuple (remaining, reset) or None if the headers are missing or malformed.
+    """
+    remaining = headers.get("X-Ratelimit-Remaining")
+    reset = headers.get("X-Ratelimit-Reset")
+    if remaining is None or reset is None:
+        return None
+    try:
+        return float(remaining), float(reset)
+    except ValueError:
+        return None
+
+
+# %%
+## Define classes
+class RateLimiter:
+    """
+    A token bucket shared by all the requests sent to one API. It spaces out
+    the requests, slows down when the rate-limit headers say the budget is
+    running out, and pauses every caller after a throttled response using an
+    exponential backoff with jitter. It is thread safe and can be used both from
+    regular code (acquire) and from coroutines (acquire_async).
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        burst: int = 1,
+        base_delay: float = 2.0,
+        max_delay: float = 300.0,
+        max_retries: int = 10,
+        seed: int | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        rate, optional
+            number of requests per second, by default 1.0
+        burst, optional
+            number of requests which may be sent at once, by default 1
+        base_delay, optional
+            the first backoff delay in seconds, by default 2.0
+        max_delay, optional
+            the longest backoff delay in seconds, by default 300.0
+        max_retries, optional
+            number of retries before giving up on a request, by default 10
+        seed, optional
+            seed of the jitter, by default None
+        """
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def _reserve(self) -> float:
+        """Takes one token from the bucket and returns how long the caller has to
+        wait before sending its request. The bucket may go below zero so the
+        callers queue up in the order they asked."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def acquire(self) -> None:
+        """Blocks until a request may be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Waits until a request may be sent without blocking the event loop."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stops every caller for the given number of seconds.
+
+        Parameters
+        ----------
+        seconds
+            length of the break.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, headers) -> None:
+        """Adapts the rate to the budget reported by the rate-limit headers. When
+        the budget is used up it pauses every caller until it resets.
+
+        Parameters
+        ----------
+        headers
+            a case-insensitive mapping with the response headers.
+        """
+        limit = parse_rate_limit(headers)
+        if limit is None:
+            return
+        remaining, reset = limit
+        if remaining < 1:
+            self.pause(reset)
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, remaining / max(reset, 1.0))
+
+    def backoff(self, attempt: int, headers=None) -> float:
+        """Pauses every caller after a throttled or failed response. The delay
+        grows exponentially with the attempt, is jittered so the workers do not
+        retry in lockstep, and is never shorter than the Retry-After header.
+
+        Parameters
+        ----------
+        attempt
+            number of the failed attempt starting from 0.
+        headers, optional
+            a case-insensitive mapping with the response headers, by default None
+
+        Returns
+        -------
+            length of the break in seconds.
+        """
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = self._rng.uniform(delay / 2, delay)
+        retry_after = parse_retry_after(headers) if headers is not None else None
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.pause(delay)
+        return delay
+
+
+class RateLimitedRequestor(Requestor):
+    """
+    Subclass of prawcore.Requestor which sends every request of a praw.Reddit
+    instance through a RateLimiter. Many instances can share one limiter.
+
+    Example
+    -------
+    reddit = praw.Reddit(
+        ...,
+        requestor_class=RateLimitedRequestor,
+        requestor_kwargs={"rate_limiter": rate_limiter},
+    )
+    """
+
+    def __init__(self, *args, rate_limiter: RateLimiter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self._failures = 0
+
+    def request(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        response = super().request(*args, **kwargs)
+        self.rate_limiter.update(response.headers)
+        ## prawcore retries or raises on its own, here we only make sure the other
+        ## sessions sharing the limiter back off as well.
+        if response.status_code in RETRY_STATUS_CODES:
+            self.rate_limiter.backoff(attempt=self._failures, headers=response.headers)
+            self._failures += 1
+        else:
+            self._failures = 0
+        return response
@@ -0,0 +1,291 @@
+# %%
+import argparse
+import hashlib
+import json
+import os
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path
+
+import nltk
+import pyarrow as pa
+import pyarrow.parquet as pq
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from tqdm import tqdm
+
+from writers import JsonlWriter
+
+# %%
+## Define globals
+## The text fields which are scored and the suffix of their sentiment columns.
+## A comment has a body and a submission a title, both are scored into the
+## columns without a suffix (like get_data.py), the first one a row has wins
+FIELDS = {"body": "", "title": "", "selftext": "_selftext"}
+## The fields which are left without a score when they are empty or deleted
+OPTIONAL_FIELDS = ("selftext",)
+SCORES = ("pos", "neg", "neu", "compound", "adjusted_compound")
+## Every worker process creates its own analyzer
+vader = None
+
+
+# %%
+## Define functions
+def init_worker() -> None:
+    """Creates the analyzer of a worker process."""
+    global vader
+    vader = SentimentIntensityAnalyzer()
+
+
+def polarity_scores(texts: list) -> list:
+    """Scores a batch of texts.
+
+    Parameters
+    ----------
+    texts
+        a list of strings.
+
+    Returns
+    -------
+        a list of tuples (pos, neg, neu, compound, adjusted_compound), where the
+        adjusted compound is the compound weighted by the share of words which
+        are not neutral (like the sentiment in get_all_comments.py).
+    """
+    if vader is None:
+        init_worker()
+    scores = []
+    for text in texts:
+        score = vader.polarity_scores(text)
+        adjusted_compound = score["compound"] * (1 - score["neu"])
+        scores.append(
+            (
+                score["pos"],
+                score["neg"],
+                score["neu"],
+                score["compound"],
+                adjusted_compound,
+            )
+        )
+    return scores
+
+
+def is_scored(field: str, text) -> bool:
+    """Checks whether a text has to be scored (get_data.py skips empty or deleted selftexts)."""
+    if not isinstance(text, str):
+        return False
+    if field in OPTIONAL_FIELDS:
+        return len(text) > 0 and "[deleted]" not in text
+    return True
+
+
+def digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+# %%
+## Define classes
+class SentimentScorer:
+    """
+    Scores the text fields of many rows at once. Every distinct text is scored
+    only once (the texts are keyed by their hash, so repeated titles, bodies
+    or "[removed]" placeholders cost nothing), and the new texts are spread
+    over a pool of processes.
+    """
+
+    def __init__(
+        self, fields: dict | None = None, workers: int = 1, chunksize: int = 1_000
+    ):
+        """
+        Parameters
+        ----------
+        fields, optional
+            a mapping from the text fields to the suffix of their sentiment
+            columns, by default FIELDS
+        workers, optional
+            number of processes, by default 1 (no pool)
+        chunksize, optional
+            number of texts sent to a process at once, by default 1_000
+        """
+        self.fields = FIELDS if fields is None else fields
+        self.chunksize = chunksize
+        self._cache = {}
+        self._pool = Pool(workers, initializer=init_worker) if workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def _score(self, texts: dict) -> None:
+        keys = list(texts)
+        values = list(texts.values())
+        batches = [
+            values[i : i + self.chunksize]
+            for i in range(0, len(values), self.chunksize)
+        ]
+        if self._pool is None:
+            results = map(polarity_scores, batches)
+        else:
+            results = self._pool.imap(polarity_scores, batches)
+        scores = [score for batch in results for score in batch]
+        self._cache.update(zip(keys, scores))
+
+    def score_columns(self, columns: dict) -> dict:
+        """Scores the text columns of a batch of rows.
+
+        Parameters
+        ----------
+        columns
+            a mapping from the text fields to lists of texts (None if a row has no text).
+
+        Returns
+        -------
+            a mapping from the sentiment columns (e.g. pos, compound_selftext) to
+            lists of scores (None if a text was not scored). Of the fields with
+            the same suffix only the first text of a row (in the order of fields)
+            is scored.
+        """
+        ## The keys of the scored texts by the suffix of their columns
+        keys = {}
+        new = {}
+        for field in self.fields:
+            if field not in columns:
+                continue
+            suffix = self.fields[field]
+            texts = columns[field]
+            suffix_keys = keys.setdefault(suffix, [None] * len(texts))
+            for i, text in enumerate(texts):
+                if suffix_keys[i] is not None or not is_scored(field, text):
+                    continue
+                key = digest(text)
+                suffix_keys[i] = key
+                if key not in self._cache:
+                    new[key] = text
+        self._score(new)
+        scored = {}
+        for suffix, suffix_keys in keys.items():
+            for i, score in enumerate(SCORES):
+                scored[score + suffix] = [
+                    None if key is None else self._cache[key][i] for key in suffix_keys
+                ]
+        return scored
+
+
+# %%
+## Define functions
+def score_jsonl(
+    path: str, output: str, scorer: SentimentScorer, batch_size: int = 50_000
+) -> None:
+    """Adds the sentiment columns to every row of a JSON line file.
+
+    Parameters
+    ----------
+    path
+        a path to the JSON line file.
+    output
+        a path to the scored JSON line file.
+    scorer
+        a SentimentScorer.
+    batch_size, optional
+        number of rows read at once, by default 50_000
+    """
+    with open(path, "r") as file, JsonlWriter(output) as writer:
+        pbar = tqdm()
+        while True:
+            rows = [json.loads(line) for line in islice(file, batch_size)]
+            if len(rows) == 0:
+                break
+            fields = [
+                field for field in scorer.fields if any(field in row for row in rows)
+            ]
+            columns = scorer.score_columns(
+                {field: [row.get(field) for row in rows] for field in fields}
+            )
+            for i, row in enumerate(rows):
+                for column, values in columns.items():
+                    row[column] = values[i]
+                writer.write(row)
+            pbar.update(len(rows))
+        pbar.close()
+
+
+def score_parquet(
+    path: str, output: str, scorer: SentimentScorer, batch_size: int = 50_000
+) -> None:
+    """Adds the sentiment columns to a Parquet file or to every file of a
+    partitioned Parquet dataset. The scored files keep the partitions.
+
+    Parameters
+    ----------
+    path
+        a path to the Parquet file or the dataset directory.
+    output
+        a path to the scored Parquet file or dataset directory.
+    scorer
+        a SentimentScorer.
+    batch_size, optional
+        number of rows read at once, by default 50_000
+    """
+    path, output = Path(path), Path(output)
+    files = [path] if path.is_file() else sorted(path.glob("**/*.parquet"))
+    for file in tqdm(files):
+        target = output if path.is_file() else output / file.relative_to(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        parquet = pq.ParquetFile(file)
+        writer = None
+        for batch in parquet.iter_batches(batch_size=batch_size):
+            table = pa.Table.from_batches([batch])
+            fields = [field for field in scorer.fields if field in table.column_names]
+            columns = scorer.score_columns(
+                {field: table.column(field).to_pylist() for field in fields}
+            )
+            for column, values in columns.items():
+                if column in table.column_names:
+                    table = table.drop_columns([column])
+                table = table.append_column(column, pa.array(values, type=pa.float64()))
+            if writer is None:
+                writer = pq.ParquetWriter(str(target) + ".tmp", table.schema)
+            writer.write_table(table)
+        if writer is None:
+            pq.write_table(parquet.schema_arrow.empty_table(), str(target) + ".tmp")
+        else:
+            writer.close()
+        os.replace(str(target) + ".tmp", target)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the VADER sentiment (pos, neg, neu, compound and adjusted_compound) "
+        "to the comments or submissions collected by get_data.py or get_all_comments.py."
+    )
+    parser.add_argument(
+        "path", help="a JSON line file or a Parquet file/dataset directory"
+    )
+    parser.add_argument(
+        "--output", help="by default the input path with a _sentiment suffix"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of processes"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=50_000, help="number of rows read at once"
+    )
+    args = parser.parse_args()
+    path = Path(args.path)
+    output = args.output or path.with_name(f"{path.stem}_sentiment{path.suffix}")
+    nltk.download("vader_lexicon")
+
+    with SentimentScorer(workers=args.workers) as scorer:
+        if path.is_dir() or path.suffix == ".parquet":
+            score_parquet(path, output, scorer=scorer, batch_size=args.batch_size)
+        else:
+            score_jsonl(path, output, scorer=scorer, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
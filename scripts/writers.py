@@ -0,0 +1,358 @@
+# %%
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# %%
+## Define globals
+## Columns whose type can not be inferred from a batch of rows
+REDDIT_TYPES = {"edited": pa.float64()}
+## Nested (or sometimes nested) fields of Reddit objects, always stored as JSON
+## text, so they have the same type in every part file
+REDDIT_JSON_COLUMNS = {
+    "all_awardings",
+    "author_flair_richtext",
+    "awarders",
+    "collections",
+    "crosspost_parent_list",
+    "gallery_data",
+    "gildings",
+    "link_flair_richtext",
+    "media",
+    "media_embed",
+    "media_metadata",
+    "mod_reports",
+    "poll_data",
+    "preview",
+    "secure_media",
+    "secure_media_embed",
+    "treatment_tags",
+    "user_reports",
+}
+
+
+# %%
+## Define classes
+class JsonlWriter:
+    """
+    Writes rows out to a JSON line file, one mapping per line.
+    """
+
+    def __init__(self, path: str, mode: str = "w"):
+        """
+        Parameters
+        ----------
+        path
+            a path to the JSON line file.
+        mode, optional
+            "w" to start a fresh file or "a" to append to it, by default "w"
+        """
+        self.name = str(path)
+        ## The writer owns the file and closes it in close() (or at the end of a with-block)
+        self._file = open(path, mode)  # noqa: SIM115
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, row: dict) -> None:
+        """Writes out one row."""
+        self._file.write(json.dumps(row) + "\n")
+
+    def flush(self) -> None:
+        """Makes sure everything written so far is on disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def tell(self) -> int:
+        """Returns the size of the file written so far."""
+        return self._file.tell()
+
+    def defer(self, callback) -> None:
+        """Flushes the file and calls the callback (e.g. a checkpoint update)."""
+        self.flush()
+        callback()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class PartitionedParquetWriter:
+    """
+    Writes rows out to a Parquet dataset partitioned by subreddit and month (or
+    any other keys), e.g. path/subreddit=urbanplanning/month=2021-03/part-*.parquet.
+    The rows are buffered and every flush writes one file (one record batch) per
+    partition, so downstream loads can read only the columns and partitions they
+    need, compare read_table. The rows covered by a deferred callback and the
+    rows written after it go to separate files, so a checkpoint never counts a
+    file with rows it does not record, compare rollback.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        partition_by=None,
+        mode: str = "w",
+        batch_size: int = 50_000,
+        types: dict | None = None,
+        json_columns: set | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        path
+            a path to the dataset directory.
+        partition_by, optional
+            a function which takes a row and returns a mapping with the partition
+            keys and values, by default month_partition()
+        mode, optional
+            "w" to remove the files written before or "a" to add to them, by default "w"
+        batch_size, optional
+            number of rows buffered before they are written out, by default 50_000
+        types, optional
+            a mapping from column names to pyarrow types for the columns whose
+            type can not be inferred, by default REDDIT_TYPES
+        json_columns, optional
+            names of the columns stored as JSON text, by default REDDIT_JSON_COLUMNS.
+            Any other column becomes JSON text once it holds a nested or a mixed
+            value and stays so for the rest of the run.
+        """
+        self.name = str(path)
+        self.partition_by = partition_by or month_partition()
+        self.batch_size = batch_size
+        self.types = REDDIT_TYPES if types is None else types
+        self.json_columns = set(
+            REDDIT_JSON_COLUMNS if json_columns is None else json_columns
+        )
+        self._path = Path(path)
+        ## Rows covered by a deferred callback and rows written after the last one
+        self._buffers = {}
+        self._pending = {}
+        self._buffered = 0
+        self._written = 0
+        ## Number of committed files of the earlier runs, compare rollback
+        self._committed = {}
+        self._callbacks = []
+        self._run = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        if mode == "w":
+            for part in self._path.glob("**/part-*.parquet"):
+                part.unlink()
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, row: dict) -> None:
+        """Buffers one row and writes out the buffer when it is full."""
+        keys = tuple(self.partition_by(row).items())
+        self._pending.setdefault(keys, []).append(row)
+        self._buffered += 1
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def _to_table(self, rows: list) -> pa.Table:
+        columns = dict.fromkeys(key for row in rows for key in row)
+        arrays = {}
+        for column in columns:
+            values = [row.get(column) for row in rows]
+            if column not in self.json_columns:
+                if not any(isinstance(value, (dict, list)) for value in values):
+                    try:
+                        arrays[column] = pa.array(values, type=self.types.get(column))
+                        continue
+                    except (pa.ArrowInvalid, pa.ArrowTypeError):
+                        pass
+                ## Nested or mixed values, keep the column as JSON text from now on
+                self.json_columns.add(column)
+            arrays[column] = pa.array(
+                [None if value is None else json.dumps(value) for value in values],
+                type=pa.string(),
+            )
+        return pa.table(arrays)
+
+    def _write_parts(self, buffers: dict) -> None:
+        for keys, rows in buffers.items():
+            directory = self._path.joinpath(*[f"{key}={value}" for key, value in keys])
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"part-{self._run}-{self._written:05d}.parquet"
+            ## Write to a temporary file first, so a crash never leaves half a file
+            pq.write_table(self._to_table(rows), str(path) + ".tmp")
+            os.replace(str(path) + ".tmp", path)
+            self._written += 1
+
+    def flush(self) -> None:
+        """Writes out every buffered partition into a new file. The deferred
+        callbacks are called once the rows they cover are on disk and before the
+        rows written after them are."""
+        self._write_parts(self._buffers)
+        for callback in self._callbacks:
+            callback()
+        self._write_parts(self._pending)
+        self._buffers = {}
+        self._pending = {}
+        self._buffered = 0
+        self._callbacks = []
+
+    def tell(self) -> dict:
+        """Returns the number of files written so far by this run and the
+        committed ones of the earlier runs, keyed by the run."""
+        return {**self._committed, self._run: self._written}
+
+    def defer(self, callback) -> None:
+        """Calls the callback (e.g. a checkpoint update) once the rows written so
+        far are on disk, i.e. after the next flush."""
+        for keys, rows in self._pending.items():
+            self._buffers.setdefault(keys, []).extend(rows)
+        self._pending = {}
+        self._callbacks.append(callback)
+
+    def rollback(self, committed: dict) -> None:
+        """Removes the files which are not committed, i.e. which were written
+        after the last checkpoint update of their run (or by a run which never
+        updated it), so the rows a resumed crawl collects again are not
+        duplicated.
+
+        Parameters
+        ----------
+        committed
+            a mapping from the run to its number of committed files, as tell()
+            returned it when the checkpoint was updated.
+        """
+        self._committed = dict(committed)
+        for part in self._path.glob("**/part-*.parquet*"):
+            run, index = part.name.split(".")[0][len("part-") :].rsplit("-", 1)
+            if part.suffix == ".tmp" or int(index) >= committed.get(run, 0):
+                part.unlink()
+
+    def close(self) -> None:
+        self.flush()
+
+
+# %%
+## Define functions
+def month_partition(
+    subreddit: str | None = None,
+    date_key: str = "created_utc",
+    date_format: str = "%Y-%m-%d %H:%M:%S",
+):
+    """Returns a function which partitions the rows by subreddit and month.
+
+    Parameters
+    ----------
+    subreddit, optional
+        name of the subreddit, by default None (taken from the subreddit field of a row)
+    date_key, optional
+        the field with the creation date, by default "created_utc"
+    date_format, optional
+        the format of the creation date, by default "%Y-%m-%d %H:%M:%S"
+
+    Returns
+    -------
+        a function which takes a row and returns {"subreddit": ..., "month": "YYYY-MM"}.
+    """
+
+    def partition_by(row: dict) -> dict:
+        month = datetime.strptime(row[date_key], date_format).strftime("%Y-%m")
+        return {"subreddit": subreddit or row["subreddit"], "month": month}
+
+    return partition_by
+
+
+def make_writer(format: str, path: str, mode: str = "w", **kwargs):
+    """Creates a writer for the given format.
+
+    Parameters
+    ----------
+    format
+        either "jsonl" or "parquet".
+    path
+        a path to the JSON line file. For Parquet the extension is dropped and
+        the path is used as the dataset directory.
+    mode, optional
+        "w" to start from scratch or "a" to append, by default "w"
+    **kwargs
+        passed to PartitionedParquetWriter (partition_by, batch_size, types).
+
+    Returns
+    -------
+        a JsonlWriter or a PartitionedParquetWriter.
+    """
+    if format == "jsonl":
+        return JsonlWriter(path, mode=mode)
+    elif format == "parquet":
+        return PartitionedParquetWriter(Path(path).with_suffix(""), mode=mode, **kwargs)
+    raise ValueError(f"Unknown format {format}")
+
+
+def unify_schemas(schemas: list) -> pa.Schema:
+    """Unifies the schemas of the part files column by column. The types of a
+    column are promoted where possible (e.g. null to int64 to float64), a column
+    whose types can not be merged (e.g. int64 in one file and string in another)
+    is read as text.
+
+    Parameters
+    ----------
+    schemas
+        a list of pyarrow schemas.
+
+    Returns
+    -------
+        the unified schema.
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, []).append(field.type)
+    fields = []
+    for name, column_types in types.items():
+        try:
+            fields.append(
+                pa.unify_schemas(
+                    [pa.schema([pa.field(name, type)]) for type in column_types],
+                    promote_options="permissive",
+                ).field(name)
+            )
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(pa.field(name, pa.string()))
+    return pa.schema(fields)
+
+
+def read_table(path: str, columns: list | None = None, filter=None):
+    """Reads a partitioned Parquet dataset into a data frame. Only the columns
+    and the partitions which are asked for are read from disk.
+
+    Parameters
+    ----------
+    path
+        a path to the dataset directory.
+    columns, optional
+        a list of columns to read, by default None (all of them)
+    filter, optional
+        a pyarrow.dataset expression, e.g.
+        (ds.field("subreddit") == "urbanplanning") & (ds.field("month") >= "2021-01"),
+        by default None
+
+    Returns
+    -------
+        a pandas.DataFrame.
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    ## The files may have different columns (or null columns), so unify them
+    schema = unify_schemas([pq.read_schema(file) for file in dataset.files])
+    for field in dataset.schema:
+        if field.name not in schema.names:
+            schema = schema.append(field)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive", schema=schema)
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()